@@ -0,0 +1,9 @@
+import sys
+
+# config.py parses the command line on import, give it placeholders so bot modules can be imported
+_argv = sys.argv
+sys.argv = [sys.argv[0], "--token", "0:benchmark", "--bot_name", "benchmark", "--db_password", "",
+            "--flibusta_server_public", "http://localhost", "--server_port", "0",
+            "--redis_host", "localhost", "--redis_password", "", "--chatbase_api_key", ""]
+import config  # noqa: E402,F401
+sys.argv = _argv
@@ -0,0 +1,229 @@
+# Stand-in for the flibusta server API with synthetic data.
+# Run from the source directory: python -m benchmarks.fake_flibusta --port 7770 --latency 0.05 --file_size 2000000
+import asyncio
+import random
+import zlib
+from datetime import date
+
+import fire
+from aiohttp import web
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+FIRST_NAMES = ["Лев", "Фёдор", "Анна", "Михаил", "Марина", "Иван", "Ольга", "Сергей"]
+LAST_NAMES = ["Толстой", "Достоевский", "Ахматова", "Булгаков", "Цветаева", "Тургенев", "Берггольц", "Есенин"]
+MIDDLE_NAMES = ["Николаевич", "Михайлович", "Андреевна", "Афанасьевич", "Ивановна", "Сергеевич", ""]
+WORDS = ["Война", "мир", "Идиот", "Мастер", "Маргарита", "Отцы", "дети", "ночь", "Белая", "гвардия", "Тихий",
+         "Дон", "Мёртвые", "души", "Герой", "нашего", "времени", "Записки", "охотника"]
+LANGS = ["ru", "uk", "be"]
+FILE_TYPES = ["fb2", "fb2", "fb2", "epub", "pdf", "djvu"]
+
+
+def query_id(query: str) -> int:  # hash() of a str changes between processes
+    return zlib.crc32(query.lower().encode()) % 1_000_000
+
+
+class FakeFlibusta:
+    def __init__(self, books: int = 100_000, authors: int = 20_000, sequences: int = 5_000,
+                 latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 file_size: int = 1_000_000, bulk: bool = True, seed: int = 0):
+        self.books = books
+        self.authors = authors
+        self.sequences = sequences
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.file_size = file_size
+        self.bulk = bulk
+        self.seed = seed
+
+        self.random = random.Random(seed)
+
+    def _rng(self, kind: str, item_id: int) -> random.Random:
+        return random.Random(f"{self.seed}:{kind}:{item_id}")
+
+    def author(self, author_id: int) -> dict:
+        rng = self._rng("author", author_id)
+        return {
+            "id": author_id,
+            "first_name": rng.choice(FIRST_NAMES),
+            "last_name": rng.choice(LAST_NAMES),
+            "middle_name": rng.choice(MIDDLE_NAMES),
+            "annotation_exists": rng.random() < 0.5
+        }
+
+    def book(self, book_id: int) -> dict:
+        rng = self._rng("book", book_id)
+        return {
+            "id": book_id,
+            "title": " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 5))),
+            "lang": rng.choice(LANGS),
+            "file_type": rng.choice(FILE_TYPES),
+            "annotation_exists": rng.random() < 0.7,
+            "authors": [self.author(rng.randint(1, self.authors)) for _ in range(rng.choice((0, 1, 1, 1, 2, 3)))]
+        }
+
+    def sequence(self, sequence_id: int) -> dict:
+        rng = self._rng("sequence", sequence_id)
+        return {
+            "id": sequence_id,
+            "name": " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))),
+            "authors": [self.author(rng.randint(1, self.authors)) for _ in range(rng.randint(1, 2))]
+        }
+
+    def book_ids_for(self, kind: str, item_id: int, count: int):
+        rng = self._rng(kind, item_id)
+        return [rng.randint(1, self.books) for _ in range(count)]
+
+    def page(self, ids, make, allowed_langs, limit: int, page: int, lang_filter: bool = True) -> dict:
+        items = [make(i) for i in ids]
+        if lang_filter:
+            items = [item for item in items if item.get("lang", "ru") in allowed_langs]
+        return {"count": len(items), "result": items[(page - 1) * limit:page * limit]}
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler):
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.Response(status=self.random.choice((500, 502, 503)))
+        return await handler(request)
+
+    async def get_book(self, request: web.Request) -> web.Response:
+        book_id = int(request.match_info["id"])
+        if book_id > self.books:
+            return web.Response(status=204)
+        return web.json_response(self.book(book_id), dumps=json.dumps)
+
+    async def get_books_bulk(self, request: web.Request) -> web.Response:
+        if not self.bulk:
+            return web.Response(status=404)
+        ids = [i for i in json.loads(request.match_info["ids"]) if i <= self.books]
+        return web.json_response({"count": len(ids), "result": [self.book(i) for i in ids]}, dumps=json.dumps)
+
+    async def search_books(self, request: web.Request) -> web.Response:
+        query = request.match_info["query"]
+        ids = self.book_ids_for("book_search", query_id(query), 60)
+        return self._page_response(request, ids, self.book)
+
+    async def search_authors(self, request: web.Request) -> web.Response:
+        rng = self._rng("author_search", query_id(request.match_info["query"]))
+        ids = [rng.randint(1, self.authors) for _ in range(25)]
+        return self._page_response(request, ids, self.author, lang_filter=False)
+
+    async def search_sequences(self, request: web.Request) -> web.Response:
+        rng = self._rng("sequence_search", query_id(request.match_info["query"]))
+        ids = [rng.randint(1, self.sequences) for _ in range(20)]
+        return self._page_response(request, ids, self.sequence, lang_filter=False)
+
+    def _page_response(self, request: web.Request, ids, make, lang_filter: bool = True) -> web.Response:
+        data = self.page(ids, make, json.loads(request.match_info["langs"]), int(request.match_info["limit"]),
+                         int(request.match_info["page"]), lang_filter)
+        if data["count"] == 0:
+            return web.Response(status=204)
+        return web.json_response(data, dumps=json.dumps)
+
+    async def get_author(self, request: web.Request) -> web.Response:
+        author_id = int(request.match_info["id"])
+        if author_id > self.authors:
+            return web.Response(status=204)
+        data = self.page(self.book_ids_for("author_books", author_id, 40), self.book,
+                         json.loads(request.match_info["langs"]),
+                         int(request.match_info["limit"]), int(request.match_info["page"]))
+        author = self.author(author_id)
+        author["books"] = data["result"]
+        return web.json_response({"count": data["count"], "result": author}, dumps=json.dumps)
+
+    async def get_sequence(self, request: web.Request) -> web.Response:
+        sequence_id = int(request.match_info["id"])
+        if sequence_id > self.sequences:
+            return web.Response(status=204)
+        data = self.page(self.book_ids_for("sequence_books", sequence_id, 15), self.book,
+                         json.loads(request.match_info["langs"]),
+                         int(request.match_info["limit"]), int(request.match_info["page"]))
+        sequence = self.sequence(sequence_id)
+        sequence["books"] = data["result"]
+        return web.json_response({"count": data["count"], "result": sequence}, dumps=json.dumps)
+
+    async def get_random(self, request: web.Request) -> web.Response:
+        kind = request.match_info["kind"]
+        if kind == "book":
+            langs = json.loads(request.match_info["langs"])
+            for _ in range(100):
+                book = self.book(self.random.randint(1, self.books))
+                if book["lang"] in langs:
+                    return web.json_response(book, dumps=json.dumps)
+            return web.Response(status=204)
+        if kind == "author":
+            return web.json_response(self.author(self.random.randint(1, self.authors)), dumps=json.dumps)
+        sequence = self.sequence(self.random.randint(1, self.sequences))
+        sequence["books"] = []
+        return web.json_response(sequence, dumps=json.dumps)
+
+    async def get_annotation(self, request: web.Request) -> web.Response:
+        kind = request.match_info["kind"]
+        item_id = int(request.match_info["id"])
+        rng = self._rng(f"{kind}_annotation", item_id)
+        body = "".join(f'<p class="book">{" ".join(rng.choice(WORDS) for _ in range(40))}</p>'
+                       for _ in range(rng.randint(1, 30)))
+        return web.json_response({
+            f"{kind}_id": item_id,
+            "title": "",
+            "body": body,
+            "file": f"{item_id}.jpg" if rng.random() < 0.3 else None
+        }, dumps=json.dumps)
+
+    async def get_update_log(self, request: web.Request) -> web.Response:
+        start = date.fromisoformat(request.match_info["start"])
+        end = date.fromisoformat(request.match_info["end"])
+        ids = []
+        for ordinal in range(start.toordinal(), end.toordinal() + 1):
+            rng = self._rng("update_log", ordinal)
+            ids.extend(rng.randint(1, self.books) for _ in range(rng.randint(50, 300)))
+        return self._page_response(request, ids, self.book)
+
+    async def download(self, request: web.Request) -> web.StreamResponse:
+        book_id = int(request.match_info["id"])
+        if book_id > self.books:
+            return web.Response(status=404)
+        response = web.StreamResponse(headers={"Content-Length": str(self.file_size)})
+        await response.prepare(request)
+        if request.method == "HEAD":
+            return response
+        chunk = b"\0" * 65536
+        remaining = self.file_size
+        while remaining > 0:
+            await response.write(chunk[:remaining])
+            remaining -= len(chunk)
+        await response.write_eof()
+        return response
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware])
+        search = "{langs}/{limit:\\d+}/{page:\\d+}/{query:.*}"
+        listing = "{langs}/{limit:\\d+}/{page:\\d+}"
+        app.router.add_get("/book/bulk/{ids}", self.get_books_bulk)
+        app.router.add_get(f"/book/search/{search}", self.search_books)
+        app.router.add_get("/{kind:book|author|sequence}/random/{langs}", self.get_random)
+        app.router.add_get("/book/download/{id:\\d+}/{file_type}", self.download)
+        app.router.add_get(f"/book/update_log_range/{{start}}/{{end}}/{listing}", self.get_update_log)
+        app.router.add_get("/book/{id:\\d+}", self.get_book)
+        app.router.add_get(f"/author/search/{search}", self.search_authors)
+        app.router.add_get(f"/author/{{id:\\d+}}/{listing}", self.get_author)
+        app.router.add_get(f"/sequence/search/{search}", self.search_sequences)
+        app.router.add_get(f"/sequence/{{id:\\d+}}/{listing}", self.get_sequence)
+        app.router.add_get("/annotation/{kind:book|author}/{id:\\d+}", self.get_annotation)
+        return app
+
+
+def main(host: str = "localhost", port: int = 7770, **kwargs):
+    web.run_app(FakeFlibusta(**kwargs).make_app(), host=host, port=port)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,133 @@
+# Stand-in for the Telegram Bot API. Point the bot at it with --telegram_api_server http://localhost:8081
+# Run from the source directory: python -m benchmarks.fake_telegram --port 8081 --latency 0.03 --flood_rate 0.01
+import asyncio
+import itertools
+import random
+import secrets
+import time
+from collections import Counter
+
+import fire
+from aiohttp import web
+
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Flibusta Bot", "username": "flibusta_bot"}
+
+
+def make_file_id() -> str:
+    return "BQACAgIAAxkBAAI" + secrets.token_urlsafe(48)[:56]
+
+
+def make_file_unique_id() -> str:
+    return "AgAD" + secrets.token_urlsafe(9)[:12]
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, upload_speed: float = 0.0,
+                 error_rate: float = 0.0, flood_rate: float = 0.0, retry_after: int = 1, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.upload_speed = upload_speed  # bytes per second, 0 means instant
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+
+        self.random = random.Random(seed)
+        self.message_ids = itertools.count(1)
+        self.documents = {}  # (chat_id, message_id) -> document, so forwards carry the same file
+        self.calls = Counter()
+
+        self.methods = {
+            "getme": self.get_me,
+            "sendmessage": self.send_message,
+            "editmessagetext": self.send_message,
+            "editmessagereplymarkup": self.send_message,
+            "senddocument": self.send_document,
+            "sendphoto": self.send_photo,
+            "forwardmessage": self.forward_message,
+        }
+
+    def message(self, chat_id, **content) -> dict:
+        chat_id = int(chat_id)
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "from": BOT_USER,
+            "chat": {"id": chat_id, "type": "channel" if chat_id < 0 else "private"},
+            **content
+        }
+
+    async def get_me(self, data) -> dict:
+        return BOT_USER
+
+    async def send_message(self, data) -> dict:
+        return self.message(data.get("chat_id", 0), text=data.get("text", ""))
+
+    async def send_document(self, data) -> dict:
+        document = data.get("document")
+        if isinstance(document, web.FileField):
+            size = document.file.seek(0, 2)
+            if self.upload_speed:
+                await asyncio.sleep(size / self.upload_speed)
+            document = {
+                "file_id": make_file_id(),
+                "file_unique_id": make_file_unique_id(),
+                "file_name": document.filename,
+                "mime_type": document.content_type,
+                "file_size": size
+            }
+        else:
+            document = {"file_id": document, "file_unique_id": make_file_unique_id()}
+        message = self.message(data["chat_id"], document=document, caption=data.get("caption", ""))
+        self.documents[(message["chat"]["id"], message["message_id"])] = document
+        return message
+
+    async def send_photo(self, data) -> dict:
+        photo = {"file_id": make_file_id(), "file_unique_id": make_file_unique_id(), "width": 320, "height": 480}
+        return self.message(data["chat_id"], photo=[photo], caption=data.get("caption", ""))
+
+    async def forward_message(self, data) -> dict:
+        document = self.documents.get((int(data["from_chat_id"]), int(data["message_id"])))
+        if document is None:
+            raise web.HTTPBadRequest(text='{"ok":false,"error_code":400,"description":"Bad Request: message to '
+                                          'forward not found"}', content_type="application/json")
+        return self.message(data["chat_id"], document=document)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        self.calls[method] += 1
+
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            }, status=429)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"},
+                                     status=500)
+
+        data = dict(await request.post())
+        handler = self.methods.get(method)
+        result = await handler(data) if handler is not None else True
+        return web.json_response({"ok": True, "result": result})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.calls))
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=60 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+
+def main(host: str = "localhost", port: int = 8081, **kwargs):
+    web.run_app(FakeTelegram(**kwargs).make_app(), host=host, port=port)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,117 @@
+# Replays synthetic updates against the bot's webhook and reports latency.
+# Start benchmarks.fake_flibusta and benchmarks.fake_telegram, then the bot with
+# --flibusta_server http://localhost:7770 --telegram_api_server http://localhost:8081, then
+# run from the source directory: python -m benchmarks.load --url http://localhost:8080/ --updates 5000
+import asyncio
+import itertools
+import random
+import time
+
+import fire
+from aiohttp import ClientSession
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+QUERIES = ["война и мир", "мастер", "толстой", "гвардия", "записки охотника", "ночь"]
+
+
+class UpdateFactory:
+    def __init__(self, users: int, books: int, authors: int, sequences: int, seed: int):
+        self.users = users
+        self.books = books
+        self.authors = authors
+        self.sequences = sequences
+        self.random = random.Random(seed)
+        self.update_ids = itertools.count(1)
+
+        self.kinds = {
+            "download": (self.command, lambda: f"/{self.random.choice(('fb2', 'epub', 'mobi'))}_"
+                                               f"{self.random.randint(1, self.books)}", 30),
+            "search": (self.command, lambda: self.random.choice(QUERIES), 25),
+            "search_page": (self.callback, lambda: f"b_{self.random.randint(1, 3)}", 10),
+            "author": (self.command, lambda: f"/a_{self.random.randint(1, self.authors)}", 10),
+            "sequence": (self.command, lambda: f"/s_{self.random.randint(1, self.sequences)}", 5),
+            "annotation": (self.command, lambda: f"/b_info_{self.random.randint(1, self.books)}", 10),
+            "random": (self.command, lambda: self.random.choice(("/random_book", "/random_author")), 10),
+        }
+
+    def user(self) -> dict:
+        user_id = self.random.randint(1, self.users)
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}",
+                "language_code": "ru"}
+
+    def message(self, user: dict, text: str) -> dict:
+        message = {"message_id": self.random.randint(1, 10 ** 6), "date": int(time.time()), "from": user,
+                   "chat": {"id": user["id"], "type": "private"}, "text": text}
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return message
+
+    def command(self, text: str) -> dict:
+        return {"update_id": next(self.update_ids), "message": self.message(self.user(), text)}
+
+    def callback(self, data: str) -> dict:
+        user = self.user()
+        message = self.message(user, "")
+        message["from"] = {"id": 1, "is_bot": True, "first_name": "bot"}
+        message["reply_to_message"] = self.message(user, self.random.choice(QUERIES))
+        return {"update_id": next(self.update_ids), "callback_query": {
+            "id": str(self.random.randint(1, 10 ** 12)), "from": user, "message": message,
+            "chat_instance": str(user["id"]), "data": data
+        }}
+
+    def make(self):
+        kinds = list(self.kinds)
+        kind = self.random.choices(kinds, weights=[self.kinds[k][2] for k in kinds])[0]
+        build, payload, _ = self.kinds[kind]
+        return kind, build(payload())
+
+
+def percentile(ordered, percent: float) -> float:
+    return ordered[int(percent / 100 * (len(ordered) - 1))] if ordered else 0.0
+
+
+async def run(url: str, updates: int, concurrency: int, factory: UpdateFactory):
+    latencies = {}
+    failures = 0
+    queue = asyncio.Queue()
+    for _ in range(updates):
+        queue.put_nowait(factory.make())
+
+    async def worker(session: ClientSession):
+        nonlocal failures
+        while not queue.empty():
+            kind, update = queue.get_nowait()
+            start = time.perf_counter()
+            async with session.post(url, data=json.dumps(update),
+                                    headers={"Content-Type": "application/json"}) as response:
+                await response.read()
+                if response.status != 200:
+                    failures += 1
+            latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    print(f"{updates} updates in {elapsed:.1f} s ({updates / elapsed:.0f} updates/s), {failures} failed")
+    print(f"{'kind':<12}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, values in sorted(latencies.items()):
+        values.sort()
+        print(f"{kind:<12}{len(values):>8}{percentile(values, 50) * 1000:>10.1f}"
+              f"{percentile(values, 95) * 1000:>10.1f}{percentile(values, 99) * 1000:>10.1f}")
+
+
+def main(url: str = "http://localhost:8080/", updates: int = 1000, concurrency: int = 50, users: int = 500,
+         books: int = 100_000, authors: int = 20_000, sequences: int = 5_000, seed: int = 0):
+    asyncio.run(run(url, updates, concurrency, UpdateFactory(users, books, authors, sequences, seed)))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
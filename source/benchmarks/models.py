@@ -0,0 +1,159 @@
+# Rendering of a search page: dict-backed models (as they were) vs __slots__ models.
+# Run from the source directory: python -m benchmarks.models
+import timeit
+import tracemalloc
+
+import benchmarks  # noqa: F401
+from flibusta_server import BookSearchResult, json
+
+ELEMENTS_ON_PAGE = 7
+
+
+class LegacyAuthor:
+    def __init__(self, obj: dict):
+        self.obj = obj
+
+    def __del__(self):
+        del self.obj
+
+    @property
+    def first_name(self):
+        return self.obj["first_name"]
+
+    @property
+    def last_name(self):
+        return self.obj["last_name"]
+
+    @property
+    def middle_name(self):
+        return self.obj["middle_name"]
+
+    @property
+    def normal_name(self) -> str:
+        temp = ''
+        if self.last_name:
+            temp = self.last_name
+        if self.first_name:
+            if temp:
+                temp += " "
+            temp += self.first_name
+        if self.middle_name:
+            if temp:
+                temp += " "
+            temp += self.middle_name
+        return temp
+
+
+class LegacyBook:
+    def __init__(self, obj: dict):
+        self.obj = obj
+
+    def __del__(self):
+        del self.obj
+
+    @property
+    def id(self):
+        return self.obj["id"]
+
+    @property
+    def title(self):
+        return self.obj["title"]
+
+    @property
+    def lang(self):
+        return self.obj["lang"]
+
+    @property
+    def file_type(self):
+        return self.obj["file_type"]
+
+    @property
+    def annotation_exists(self):
+        return self.obj["annotation_exists"]
+
+    @property
+    def authors(self):
+        return [LegacyAuthor(a) for a in self.obj["authors"]] if self.obj.get("authors", None) else None
+
+    @property
+    def to_send_book(self) -> str:
+        res = f'📖 <b>{self.title}</b> | {self.lang}\n'
+        if self.annotation_exists:
+            res += f"Аннотация: /b_info_{self.id}\n"
+        if self.authors:
+            for a in self.authors[:15]:
+                res += f'👤 <b>{a.normal_name}</b>\n'
+            if len(self.authors) > 15:
+                res += "  и другие\n\n"
+        else:
+            res += '\n'
+        if self.file_type == 'fb2':
+            return res + f'⬇ fb2: /fb2_{self.id}\n⬇ epub: /epub_{self.id}\n⬇ mobi: /mobi_{self.id}\n\n'
+        else:
+            return res + f'⬇ {self.file_type}: /{self.file_type}_{self.id}\n\n'
+
+
+class LegacyBookSearchResult:
+    def __init__(self, obj: dict):
+        self.count: int = obj["count"]
+
+        if self.count != 0:
+            self.books = [LegacyBook(b) for b in obj["result"]]
+        else:
+            self.books = []
+
+
+def make_page() -> dict:
+    return {
+        "count": 120,
+        "result": [
+            {
+                "id": 400_000 + i,
+                "title": f"Война и мир. Том {i}",
+                "lang": "ru",
+                "file_type": "fb2",
+                "annotation_exists": i % 2 == 0,
+                "authors": [
+                    {"id": 100 + j, "first_name": "Лев", "last_name": f"Толстой{j}", "middle_name": "Николаевич",
+                     "annotation_exists": True}
+                    for j in range(3)
+                ]
+            }
+            for i in range(ELEMENTS_ON_PAGE)
+        ]
+    }
+
+
+def render(search_result) -> str:
+    return ''.join(book.to_send_book for book in search_result.books)
+
+
+def measure_memory(result_class, raw_page: str):
+    # the decoded response is included: dict-backed models keep it alive, __slots__ models don't
+    tracemalloc.start()
+    search_result = result_class(json.loads(raw_page))
+    render(search_result)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del search_result
+    return retained, peak
+
+
+def main(number: int = 20_000):
+    raw_page = json.dumps(make_page())
+    page = json.loads(raw_page)
+    assert render(LegacyBookSearchResult(page)) == render(BookSearchResult(page))
+
+    for name, result_class in (("legacy", LegacyBookSearchResult), ("slots", BookSearchResult)):
+        parse_and_render = timeit.timeit(lambda: render(result_class(page)), number=number)
+        search_result = result_class(page)
+        render(search_result)
+        rerender = timeit.timeit(lambda: render(search_result), number=number)
+        retained, peak = measure_memory(result_class, raw_page)
+        print(f"{name:>6}: parse+render {parse_and_render / number * 1e6:7.2f} us/page, "
+              f"re-render {rerender / number * 1e6:7.2f} us/page, "
+              f"retained {retained:6d} B, peak {peak:6d} B")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Upload filename normalization: translit + replace chain (as it was) vs the translation table.
+# Run from the source directory: python -m benchmarks.normalize
+import random
+import timeit
+
+import transliterate
+
+import benchmarks  # noqa: F401
+from flibusta_server import Book
+from send import FILENAME_CACHE, FILENAME_REMOVED_CHARS, FILENAME_REPLACED_CHARS, FILENAME_TABLE, normalize
+
+TITLES = [
+    "Война и мир. Том 1", "Преступление и наказание", "Мастер и Маргарита", "Горе от ума",
+    "«Тихий Дон». Книга первая", "Двенадцать стульев", "Золотой телёнок", "Что делать?",
+    "Кому на Руси жить хорошо", "Мёртвые души", "Отцы и дети", "Герой нашего времени",
+    "Доктор Живаго", "Жизнь и судьба", "Архипелаг ГУЛАГ. 1918—1956", "Белая гвардия",
+    "Понедельник начинается в субботу", "Пикник на обочине", "Трудно быть богом",
+    "Щит и меч", "Ёлка у Ивановых", "Записки юного врача", "Собачье сердце", "Чапаев и Пустота",
+    "Сборник № 3: повести и рассказы", "Лето Господне", "Юность. Отрочество", "Час быка",
+    "Эх, дороги… (стихи)", "Бег – пьеса в восьми снах", "Обломов", "Ревизор!", "Анна Каренина ",
+    "Москва — Петушки", "Дети Арбата. Книга 2/3", "Хаджи-Мурат", "Шинель", "Вий", "Нос", "Бесы",
+]
+AUTHORS = [
+    ("Лев", "Толстой", "Николаевич"), ("Фёдор", "Достоевский", "Михайлович"), ("Михаил", "Булгаков", "Афанасьевич"),
+    ("Аркадий", "Стругацкий", "Натанович"), ("Борис", "Стругацкий", "Натанович"), ("Илья", "Ильф", ""),
+    ("Евгений", "Петров", ""), ("Александр", "Солженицын", "Исаевич"), ("Николай", "Гоголь", "Васильевич"),
+    ("Иван", "Шмелёв", "Сергеевич"), ("Венедикт", "Ерофеев", "Васильевич"), ("Виктор", "Пелевин", "Олегович"),
+]
+
+
+def legacy_normalize(book: Book, file_type: str) -> str:
+    filename = '_'.join([a.short for a in book.authors]) + '_-_' if book.authors else ''
+    filename += book.title if book.title[-1] != ' ' else book.title[:-1]
+    filename = transliterate.translit(filename, 'ru', reversed=True)
+
+    for c in FILENAME_REMOVED_CHARS:
+        filename = filename.replace(c, '')
+
+    for c, r in FILENAME_REPLACED_CHARS:
+        filename = filename.replace(c, r)
+
+    return filename + '.' + file_type
+
+
+def make_books(count: int):
+    rng = random.Random(0)
+    books = []
+    for book_id in range(count):
+        authors = [{"id": i, "first_name": first, "last_name": last, "middle_name": middle}
+                   for i, (first, last, middle) in enumerate(rng.sample(AUTHORS, rng.choice((0, 1, 1, 2))))]
+        books.append(Book({"id": book_id, "title": rng.choice(TITLES), "lang": "ru", "file_type": "fb2",
+                           "authors": authors}))
+    return books
+
+
+def run(coro):  # normalize never suspends, drive it without the event loop overhead
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError("normalize suspended")
+
+
+def main(books: int = 1_000, number: int = 20):
+    corpus = make_books(books)
+
+    def table_normalize_all():
+        FILENAME_CACHE.clear()
+        for book in corpus:
+            run(normalize(book, "fb2"))
+
+    def memoized_normalize_all():
+        for book in corpus:
+            run(normalize(book, "fb2"))
+
+    for book in corpus:
+        FILENAME_CACHE.clear()
+        assert legacy_normalize(book, "fb2") == run(normalize(book, "fb2")), book.title
+    every_char = ''.join(map(chr, range(1, 0x3000)))
+    assert transliterate.translit(every_char, 'ru', reversed=True).translate(
+        {ord(c): '' for c in FILENAME_REMOVED_CHARS}).translate(
+        {ord(c): r for c, r in FILENAME_REPLACED_CHARS}) == every_char.translate(FILENAME_TABLE)
+
+    legacy = timeit.timeit(lambda: [legacy_normalize(book, "fb2") for book in corpus], number=number)
+    table = timeit.timeit(table_normalize_all, number=number)
+    memoized_normalize_all()
+    memoized = timeit.timeit(memoized_normalize_all, number=number)
+
+    for name, seconds in (("legacy", legacy), ("table", table), ("memoized", memoized)):
+        print(f"{name:>8}: {seconds / number / len(corpus) * 1e6:6.2f} us/filename")
+
+
+if __name__ == "__main__":
+    main()
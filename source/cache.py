@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Optional
+
+import metrics
+
+
+_DEFAULT_TTL = object()
+
+
+CACHES: List["TTLCache"] = []
+
+
+class TTLCache:
+    def __init__(self, max_size: int, ttl: Optional[float] = None, name: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.name = name
+        if name is not None:
+            CACHES.append(self)
+
+        self._data: OrderedDict = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        item = self._data.get(key)
+        return item is not None and not self._is_expired(item[0])
+
+    @staticmethod
+    def _is_expired(expires_at: Optional[float]) -> bool:
+        return expires_at is not None and expires_at < time.monotonic()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if self._is_expired(expires_at):
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = _DEFAULT_TTL):
+        if ttl is _DEFAULT_TTL:
+            ttl = self.ttl
+        self._data[key] = (time.monotonic() + ttl if ttl is not None else None, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def invalidate_if(self, predicate: Callable[[Hashable], bool]):
+        for key in [k for k in self._data if predicate(k)]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+metrics.counter("cache_hits_total", "In-process cache hits", ["cache"],
+                callback=lambda: {(cache.name, ): cache.hits for cache in CACHES})
+metrics.counter("cache_misses_total", "In-process cache misses", ["cache"],
+                callback=lambda: {(cache.name, ): cache.misses for cache in CACHES})
+metrics.counter("cache_evictions_total", "In-process cache evictions", ["cache"],
+                callback=lambda: {(cache.name, ): cache.evictions for cache in CACHES})
+metrics.gauge("cache_size", "In-process cache entries", ["cache"],
+              callback=lambda: {(cache.name, ): len(cache) for cache in CACHES})
@@ -14,15 +14,37 @@ class Config:
 
     FLIBUSTA_SERVER: str
     FLIBUSTA_SERVER_PUBLIC: str
+    FLIBUSTA_CONNECTIONS_LIMIT: int
+    FLIBUSTA_CONNECTIONS_LIMIT_PER_HOST: int
+    FLIBUSTA_DNS_CACHE_TTL: int
+    FLIBUSTA_KEEPALIVE_TIMEOUT: float
+
+    RANDOM_POOL_DEPTH: int
+    RANDOM_POOL_REFILL_RATE: float
+
+    TRANSFER_WORKERS: int
+    TRANSFER_PER_CHAT_LIMIT: int
+
+    PREWARM_TOP_N: int
+    PREWARM_CONCURRENCY: int
+    PREWARM_DAILY_BYTES: int
+    PREWARM_INTERVAL: float
 
     WEBHOOK_PORT: int
     WEBHOOK_HOST: str
 
+    TELEGRAM_API_SERVER: str
+    TELEGRAM_GLOBAL_RATE: float
+    TELEGRAM_CHAT_RATE: float
+    TELEGRAM_GROUP_RATE: float
+
     SERVER_HOST: str
     SERVER_PORT: int
 
     REDIS_HOST: str
     REDIS_PASSWORD: str
+    REDIS_POOL_MINSIZE: int
+    REDIS_POOL_MAXSIZE: int
     
     FLIBUSTA_BOOKS_CHANNEL_ID: str
 
@@ -41,7 +63,16 @@ class Config:
                  webhook_port: int = 8443, server_host: str = "localhost",
                  flibusta_server: str = "http://localhost:7770",
                  db_host: str = "localhost", db_port: int = 5432,
-                 flibusta_books_channel_id=None):
+                 flibusta_books_channel_id=None,
+                 flibusta_connections_limit: int = 100, flibusta_connections_limit_per_host: int = 30,
+                 flibusta_dns_cache_ttl: int = 300, flibusta_keepalive_timeout: float = 30,
+                 random_pool_depth: int = 5, random_pool_refill_rate: float = 2,
+                 telegram_api_server: str = None, telegram_global_rate: float = 30,
+                 telegram_chat_rate: float = 1, telegram_group_rate: float = 20 / 60,
+                 transfer_workers: int = 8, transfer_per_chat_limit: int = 2,
+                 prewarm_top_n: int = 30, prewarm_concurrency: int = 2,
+                 prewarm_daily_bytes: int = 2_000_000_000, prewarm_interval: float = 30 * 60,
+                 redis_pool_minsize: int = 2, redis_pool_maxsize: int = 20):
         cls.BOT_TOKEN = token
         cls.BOT_NAME = bot_name
         
@@ -53,15 +84,37 @@ class Config:
 
         cls.FLIBUSTA_SERVER = flibusta_server
         cls.FLIBUSTA_SERVER_PUBLIC = flibusta_server_public
+        cls.FLIBUSTA_CONNECTIONS_LIMIT = flibusta_connections_limit
+        cls.FLIBUSTA_CONNECTIONS_LIMIT_PER_HOST = flibusta_connections_limit_per_host
+        cls.FLIBUSTA_DNS_CACHE_TTL = flibusta_dns_cache_ttl
+        cls.FLIBUSTA_KEEPALIVE_TIMEOUT = flibusta_keepalive_timeout
+
+        cls.RANDOM_POOL_DEPTH = random_pool_depth
+        cls.RANDOM_POOL_REFILL_RATE = random_pool_refill_rate
+
+        cls.TRANSFER_WORKERS = transfer_workers
+        cls.TRANSFER_PER_CHAT_LIMIT = transfer_per_chat_limit
+
+        cls.PREWARM_TOP_N = prewarm_top_n
+        cls.PREWARM_CONCURRENCY = prewarm_concurrency
+        cls.PREWARM_DAILY_BYTES = prewarm_daily_bytes
+        cls.PREWARM_INTERVAL = prewarm_interval
 
         cls.WEBHOOK_PORT = webhook_port
         cls.WEBHOOK_HOST = f"https://kurbezz.ru:{cls.WEBHOOK_PORT}/{cls.BOT_NAME}"
 
+        cls.TELEGRAM_API_SERVER = telegram_api_server
+        cls.TELEGRAM_GLOBAL_RATE = telegram_global_rate
+        cls.TELEGRAM_CHAT_RATE = telegram_chat_rate
+        cls.TELEGRAM_GROUP_RATE = telegram_group_rate
+
         cls.SERVER_HOST = server_host
         cls.SERVER_PORT = server_port
 
         cls.REDIS_HOST = redis_host
         cls.REDIS_PASSWORD = redis_password
+        cls.REDIS_POOL_MINSIZE = redis_pool_minsize
+        cls.REDIS_POOL_MAXSIZE = redis_pool_maxsize
 
         cls.FLIBUSTA_BOOKS_CHANNEL_ID = flibusta_books_channel_id
 
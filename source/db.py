@@ -1,10 +1,13 @@
+import asyncio
 import pathlib
 from abc import ABC
-from typing import Type, Union, List
+from typing import Dict, Optional, Tuple, Type, Union, List
 
 import asyncpg
 from aiogram.types import User, CallbackQuery
 
+import metrics
+from cache import TTLCache
 from config import Config
 
 
@@ -40,17 +43,91 @@ class TablesCreator(ConfigurableDB):
         await cls.pool.execute(cls.CREATE_POSTED_BOOK_TABLE)
 
 
-class TelegramUserDB(ConfigurableDB):
+class TelegramUserDB(ConfigurableDB):  # upserts are buffered and written in batches, unchanged users are skipped
     CREATE_OR_UPDATE = open(SQL_FOLDER / "telegram_user_create_or_update.sql").read()
 
+    FLUSH_INTERVAL = 5
+    FLUSH_SIZE = 500
+
+    pending: Dict[int, Tuple[str, str, str]] = {}  # user_id -> (first_name, last_name, username)
+    written = TTLCache(max_size=100_000, ttl=24 * 60 * 60, name="telegram_user")  # rewritten at least once a day
+
+    task: Optional[asyncio.Task] = None
+    wakeup: Optional[asyncio.Event] = None
+    flush_lock: Optional[asyncio.Lock] = None
+
+    results: Dict[str, int] = {"skipped": 0, "queued": 0, "written": 0}
+
     @classmethod
     async def create_or_update(cls, obj: Union[User, CallbackQuery]):
-        await cls.pool.execute(cls.CREATE_OR_UPDATE, obj.from_user.id, obj.from_user.first_name, 
-                               obj.from_user.last_name, obj.from_user.username)
-    
+        await cls.create_or_update_raw(obj.from_user.id, obj.from_user.first_name,
+                                       obj.from_user.last_name, obj.from_user.username)
+
     @classmethod
     async def create_or_update_raw(cls, user_id: int, first_name: str, last_name: str, username: str):
-        await cls.pool.execute(cls.CREATE_OR_UPDATE, user_id, first_name, last_name, username)
+        row = (first_name, last_name, username)
+        if user_id not in cls.pending and cls.written.get(user_id) == row:
+            cls.results["skipped"] += 1
+            return
+        cls.pending[user_id] = row
+        cls.results["queued"] += 1
+        if cls.task is None:  # not started, nothing would flush it
+            await cls.flush()
+        elif len(cls.pending) >= cls.FLUSH_SIZE:
+            cls.wakeup.set()
+
+    @classmethod
+    async def ensure_exists(cls, user_id: int):  # before inserting rows that reference telegram_user
+        if user_id in cls.pending or (cls.flush_lock is not None and cls.flush_lock.locked()):
+            await cls.flush()
+
+    @classmethod
+    async def flush(cls):
+        if cls.flush_lock is None:
+            cls.flush_lock = asyncio.Lock()
+        async with cls.flush_lock:
+            rows, cls.pending = cls.pending, {}
+            if not rows:
+                return
+            try:
+                await cls.pool.executemany(cls.CREATE_OR_UPDATE,  # in key order, concurrent flushes can't deadlock
+                                           [(user_id, *row) for user_id, row in sorted(rows.items())])
+            except BaseException:
+                for user_id, row in rows.items():  # newer data queued meanwhile wins
+                    cls.pending.setdefault(user_id, row)
+                raise
+            for user_id, row in rows.items():
+                cls.written.set(user_id, row)
+            cls.results["written"] += len(rows)
+
+    @classmethod
+    def start(cls):
+        cls.wakeup = asyncio.Event()
+        cls.task = asyncio.create_task(cls._loop())
+
+    @classmethod
+    async def stop(cls):
+        if cls.task is not None:
+            cls.task.cancel()
+            try:
+                await cls.task
+            except asyncio.CancelledError:
+                pass
+            cls.task = None
+        await cls.flush()
+
+    @classmethod
+    async def _loop(cls):
+        while True:
+            try:
+                await asyncio.wait_for(cls.wakeup.wait(), cls.FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            cls.wakeup.clear()
+            try:
+                await cls.flush()
+            except Exception:
+                pass  # the rows stay queued for the next round
 
 
 class Settings:
@@ -84,6 +161,7 @@ class SettingsDB(ConfigurableDB):
 
     @classmethod
     async def update(cls, settings: Settings):
+        await TelegramUserDB.ensure_exists(settings.user_id)
         await cls.pool.execute(cls.UPDATE, settings.user_id, settings.allow_ru, settings.allow_be, settings.allow_uk)
 
 
@@ -96,6 +174,7 @@ class PostedBook:
 
 class PostedBookDB(ConfigurableDB):
     GET = open(SQL_FOLDER / "posted_book_get.sql").read()
+    GET_MANY = open(SQL_FOLDER / "posted_book_get_many.sql").read()
     CREATE_OR_UPDATE = open(SQL_FOLDER / "posted_book_create_or_update.sql").read()
     DELETE = open(SQL_FOLDER / "posted_book_delete.sql").read()
 
@@ -106,6 +185,13 @@ class PostedBookDB(ConfigurableDB):
             return None
         return PostedBook(book_id, file_type, result[0]["file_id"])
 
+    @classmethod
+    async def get_many(cls, keys: List[Tuple[int, str]]) -> Dict[Tuple[int, str], PostedBook]:
+        result = await cls.pool.fetch(cls.GET_MANY, [book_id for book_id, _ in keys],
+                                      [file_type for _, file_type in keys])
+        return {(row["book_id"], row["file_type"]): PostedBook(row["book_id"], row["file_type"], row["file_id"])
+                for row in result}
+
     @classmethod
     async def create_or_update(cls, book_id: int, file_type: str, file_id: str):
         await cls.pool.execute(cls.CREATE_OR_UPDATE, book_id, file_type, file_id)
@@ -113,3 +199,9 @@ class PostedBookDB(ConfigurableDB):
     @classmethod
     async def delete(cls, book_id: int, file_type: str):
         await cls.pool.execute(cls.DELETE, book_id, file_type)
+
+
+metrics.counter("telegram_user_upserts_total", "Telegram user upserts by outcome", ["result"],
+                callback=lambda: {(result, ): count for result, count in TelegramUserDB.results.items()})
+metrics.gauge("telegram_user_pending", "Telegram user upserts waiting for the next flush",
+              callback=lambda: {(): len(TelegramUserDB.pending)})
@@ -1,12 +1,16 @@
 # TODO: refactor all
 
+import asyncio
 import io
-from typing import List, Optional
-from datetime import date
+import re
+import time
+import tempfile
+from typing import Any, Dict, List, Optional, Set, Tuple
+from datetime import date, timedelta
 
 import aiohttp
-from aiohttp import ClientTimeout, ServerDisconnectedError
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiohttp import ClientTimeout
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputFile
 
 try:
     import ujson as json
@@ -14,147 +18,309 @@ except ImportError:
     import json
 
 
+import metrics
 from config import Config
+from cache import TTLCache
+from resilience import CircuitBreaker, LatencyTracker, RetryPolicy, ServiceUnavailable
+
+
+TELEGRAM_FILE_SIZE_LIMIT = 50_000_000
+CAPTION_LENGTH_LIMIT = 1024
+MESSAGE_LENGTH_LIMIT = 4096
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_SPOOL_SIZE = 4 * 1024 * 1024
+SIZE_PROBE_TIMEOUT = 10
+MISSING_FILE_STATUSES = (404, 410)  # other errors say nothing about whether the format exists
+MISSING_BOOK_STATUSES = (204, 404)
+LARGE_FILE_HINT = " (больше 50 МБ, только ссылкой)"
+
+BOOK_CACHE = TTLCache(max_size=10_000, ttl=60 * 60, name="book")
+AUTHOR_CACHE = TTLCache(max_size=2_000, ttl=30 * 60, name="author")
+SEQUENCE_CACHE = TTLCache(max_size=2_000, ttl=30 * 60, name="sequence")
+BOOK_ANNOTATION_CACHE = TTLCache(max_size=2_000, ttl=6 * 60 * 60, name="book_annotation")
+AUTHOR_ANNOTATION_CACHE = TTLCache(max_size=1_000, ttl=6 * 60 * 60, name="author_annotation")
+UPDATE_LOG_DAY_CACHE = TTLCache(max_size=200, name="update_log_day")
+UPDATE_LOG_RANGE_CACHE = TTLCache(max_size=100, ttl=10 * 60, name="update_log_range")
+UPDATE_LOG_TODAY_TTL = 10 * 60
+MISSING_BOOK_CACHE = TTLCache(max_size=10_000, ttl=10 * 60, name="missing_book")
+UNAVAILABLE_FILE_CACHE = TTLCache(max_size=10_000, ttl=10 * 60, name="unavailable_file")
+FILE_SIZE_CACHE = TTLCache(max_size=50_000, ttl=24 * 60 * 60, name="file_size")
+# read on every listing render: unnamed and only checked with `in`, so it stays out of the cache stats
+TOO_BIG_FILES = TTLCache(max_size=10_000, ttl=FILE_SIZE_CACHE.ttl)
+
+REQUEST_DURATION = metrics.histogram("flibusta_request_duration_seconds",
+                                     "Flibusta server request latency", ["endpoint"])
+RESPONSES = metrics.counter("flibusta_responses_total", "Flibusta server responses by status", ["endpoint", "status"])
+RESPONSE_SIZE = metrics.histogram("flibusta_response_size_bytes", "Flibusta server response body size", ["endpoint"],
+                                  buckets=(1_000, 10_000, 100_000, 1_000_000, 10_000_000, TELEGRAM_FILE_SIZE_LIMIT))
 
 
 class NoContent(Exception):
     pass
 
 
-class BytesResult(io.BytesIO):
-    def __init__(self, content):
-        super().__init__(content)
-        self.content = content
-        self.size = len(content)
-        self._name = None
+class FlibustaClient:
+    session: Optional[aiohttp.ClientSession] = None
+
+    connections_created: int = 0
+    connections_reused: int = 0
+    requests: int = 0
+
+    ENDPOINT_TIMEOUTS = {
+        "search": 10,
+        "book": 5,
+        "book_bulk": 10,
+        "author": 10,
+        "sequence": 10,
+        "annotation": 5,
+        "update_log": 15,
+        "random": 15
+    }
+    HEDGED_ENDPOINTS = {"book", "author", "sequence", "annotation"}
+    HEDGE_PERCENTILE = 95
+
+    breakers = {endpoint: CircuitBreaker(failure_threshold=5, recovery_timeout=30)
+                for endpoint in (*ENDPOINT_TIMEOUTS, "download")}  # a failing endpoint doesn't block the others
+    retry_policy = RetryPolicy(attempts=3, base_delay=0.1, max_delay=2)
+    latencies = {endpoint: LatencyTracker() for endpoint in ENDPOINT_TIMEOUTS}
+
+    retries: int = 0
+    hedged_requests: int = 0
+
+    @classmethod
+    async def configure(cls):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(cls._on_request_start)
+        trace_config.on_connection_create_end.append(cls._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(cls._on_connection_reuseconn)
+
+        connector = aiohttp.TCPConnector(limit=Config.FLIBUSTA_CONNECTIONS_LIMIT,
+                                         limit_per_host=Config.FLIBUSTA_CONNECTIONS_LIMIT_PER_HOST,
+                                         ttl_dns_cache=Config.FLIBUSTA_DNS_CACHE_TTL,
+                                         keepalive_timeout=Config.FLIBUSTA_KEEPALIVE_TIMEOUT)
+        cls.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+
+    @classmethod
+    async def close(cls):
+        if cls.session is not None:
+            await cls.session.close()
+            cls.session = None
+
+    @classmethod
+    def get(cls, path: str, **kwargs):
+        return cls.session.get(f"{Config.FLIBUSTA_SERVER}{path}", **kwargs)
+
+    @classmethod
+    def head(cls, path: str, **kwargs):
+        return cls.session.head(f"{Config.FLIBUSTA_SERVER}{path}", **kwargs)
+
+    @classmethod
+    async def get_json(cls, endpoint: str, path: str) -> Tuple[int, Any]:
+        for attempt in range(cls.retry_policy.attempts):
+            breaker = cls.breakers[endpoint]
+            if not breaker.allow():
+                raise ServiceUnavailable
+            try:
+                if endpoint in cls.HEDGED_ENDPOINTS:
+                    status, data = await cls._hedged_get_json(endpoint, path)
+                else:
+                    status, data = await cls._get_json(endpoint, path)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                breaker.record_failure()
+                if attempt == cls.retry_policy.attempts - 1:
+                    raise ServiceUnavailable
+            else:
+                if status < 500:
+                    breaker.record_success()
+                    return status, data
+                breaker.record_failure()
+                if attempt == cls.retry_policy.attempts - 1:
+                    return status, data
+            cls.retries += 1
+            await asyncio.sleep(cls.retry_policy.get_delay(attempt))
+
+    @classmethod
+    async def _get_json(cls, endpoint: str, path: str) -> Tuple[int, Any]:
+        start = time.monotonic()
+        status = "error"
+        try:
+            async with cls.get(path, timeout=ClientTimeout(total=cls.ENDPOINT_TIMEOUTS[endpoint])) as response:
+                body = await response.read()
+                status = response.status
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            REQUEST_DURATION.observe(elapsed, endpoint=endpoint)
+            RESPONSES.inc(endpoint=endpoint, status=status)
+        RESPONSE_SIZE.observe(len(body), endpoint=endpoint)
+        if status != 200:
+            return status, None
+        cls.latencies[endpoint].add(elapsed)
+        return status, json.loads(body)
+
+    @classmethod
+    async def _hedged_get_json(cls, endpoint: str, path: str) -> Tuple[int, Any]:
+        hedge_delay = cls.latencies[endpoint].percentile(cls.HEDGE_PERCENTILE)
+        if hedge_delay is None:
+            return await cls._get_json(endpoint, path)
+
+        pending = {asyncio.ensure_future(cls._get_json(endpoint, path))}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=hedge_delay)
+            if not done:
+                cls.hedged_requests += 1
+                pending.add(asyncio.ensure_future(cls._get_json(endpoint, path)))
+            while True:
+                for task in done:
+                    if task.exception() is None or not pending:
+                        return task.result()
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @classmethod
+    def stats(cls) -> dict:
+        connections = cls.connections_created + cls.connections_reused
+        return {
+            "requests": cls.requests,
+            "connections_created": cls.connections_created,
+            "connections_reused": cls.connections_reused,
+            "reuse_ratio": cls.connections_reused / connections if connections else 0.0,
+            "retries": cls.retries,
+            "hedged_requests": cls.hedged_requests,
+            "breaker_state": {endpoint: breaker.state for endpoint, breaker in cls.breakers.items()},
+            "breaker_opened": sum(breaker.opened_count for breaker in cls.breakers.values())
+        }
+
+    @classmethod
+    async def _on_request_start(cls, session, context, params):
+        cls.requests += 1
+
+    @classmethod
+    async def _on_connection_create_end(cls, session, context, params):
+        cls.connections_created += 1
+
+    @classmethod
+    async def _on_connection_reuseconn(cls, session, context, params):
+        cls.connections_reused += 1
+
+
+class FileTooBig(Exception):
+    pass
 
-    def get_copy(self):
-        _copy = BytesResult(self.content)
-        _copy.name = self.name
-        return _copy
 
-    @property
-    def name(self):
-        return self._name
+class _DownloadReader(io.RawIOBase):  # upload reader that doesn't close the shared spool
+    def __init__(self, file):
+        self.file = file
+        self.file.seek(0)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.file.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class DownloadResult:
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_SIZE)
+        self.size = 0
+        self.name = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
-    @name.setter
-    def name(self, value):
-        self._name = value
+    def write(self, chunk: bytes):
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def get_input_file(self) -> InputFile:
+        return InputFile(_DownloadReader(self.file), filename=self.name)
+
+    def close(self):
+        self.file.close()
 
 
 class AuthorSearchResult:
-    authors: List["Author"]
+    __slots__ = ("count", "authors")
 
     def __init__(self, obj: dict):
         self.count: int = obj["count"]
-
-        if self.count != 0:
-            self.authors = [Author(a) for a in obj["result"]]
-        else:
-            self.authors = []
+        self.authors: List["Author"] = [Author(x) for x in obj["result"]] if self.count != 0 else []
 
     def __bool__(self):
         return bool(self.count)
 
 
 class BookSearchResult:
-    books: List["Book"]
+    __slots__ = ("count", "books")
 
     def __init__(self, obj: dict):
         self.count: int = obj["count"]
-
-        if self.count != 0:
-            self.books = [Book(b) for b in obj["result"]]
-        else:
-            self.books = []
+        self.books: List["Book"] = [Book(x) for x in obj["result"]] if self.count != 0 else []
 
     def __bool__(self):
         return bool(self.count)
 
 
 class SequenceSearchResult:
-    sequences: List['Sequence']
+    __slots__ = ("count", "sequences")
 
     def __init__(self, obj: dict):
         self.count: int = obj["count"]
-
-        if self.count != 0:
-            self.sequences = [Sequence(s) for s in obj["result"]]
-        else:
-            self.sequences = []
+        self.sequences: List['Sequence'] = [Sequence(x) for x in obj["result"]] if self.count != 0 else []
 
     def __bool__(self):
         return self.count != 0
 
 
 class Author:
+    __slots__ = ("count", "id", "first_name", "last_name", "middle_name", "annotation_exists", "books",
+                 "_normal_name", "_short")
+
     def __init__(self, obj: dict):
         self.count = obj.get("count", None)
 
-        if obj.get("result", None) is None:
-            self.obj = obj
-        else:
-            self.obj = obj["result"]
+        if obj.get("result", None) is not None:
+            obj = obj["result"]
 
-    def __del__(self):
-        del self.obj
+        self.id = obj["id"]
+        self.first_name = obj["first_name"]
+        self.last_name = obj["last_name"]
+        self.middle_name = obj["middle_name"]
+        self.annotation_exists = obj.get("annotation_exists")
+        self.books = [Book(x) for x in obj["books"]] if obj.get("books", None) else []
+
+        self._normal_name = None
+        self._short = None
 
     def __bool__(self):
         return self.count != 0
 
-    @property
-    def id(self):
-        return self.obj["id"]
-
-    @property
-    def first_name(self):
-        return self.obj["first_name"]
-
-    @property
-    def last_name(self):
-        return self.obj["last_name"]
-
-    @property
-    def middle_name(self):
-        return self.obj["middle_name"]
-
-    @property
-    def annotation_exists(self):
-        return self.obj["annotation_exists"]
-
-    @property
-    def books(self):
-        return [Book(x) for x in self.obj["books"]] if self.obj.get("books", None) else []
-
     @property
     def normal_name(self) -> str:
-        temp = ''
-        if self.last_name:
-            temp = self.last_name
-        if self.first_name:
-            if temp:
-                temp += " "
-            temp += self.first_name
-        if self.middle_name:
-            if temp:
-                temp += " "
-            temp += self.middle_name
-        return temp
+        if self._normal_name is None:
+            self._normal_name = " ".join(name for name in (self.last_name, self.first_name, self.middle_name) if name)
+        return self._normal_name
 
     @property
     def short(self) -> str:
-        temp = ''
-        if self.last_name:
-            temp += self.last_name
-        if self.first_name:
-            if temp:
-                temp += " "
-            temp += self.first_name[0]
-        if self.middle_name:
-            if temp:
-                temp += " "
-            temp += self.middle_name[0]
-        return temp
+        if self._short is None:
+            parts = [self.last_name] if self.last_name else []
+            if self.first_name:
+                parts.append(self.first_name[0])
+            if self.middle_name:
+                parts.append(self.middle_name[0])
+            self._short = " ".join(parts)
+        return self._short
 
     @property
     def to_send(self) -> str:
@@ -167,80 +333,77 @@ class Author:
 
     @staticmethod
     async def by_id(author_id: int, allowed_langs, limit: int, page: int) -> "Author":
-        async with aiohttp.request(
-                "GET",
-                f"{Config.FLIBUSTA_SERVER}/author/{author_id}/{json.dumps(allowed_langs)}/{limit}/{page}") as response:
-            if response.status == 204:
-                raise NoContent
-            return Author(await response.json())
+        key = (author_id, tuple(allowed_langs), limit, page)
+        author = AUTHOR_CACHE.get(key)
+        if author is not None:
+            return author
+        status, data = await FlibustaClient.get_json(
+            "author", f"/author/{author_id}/{json.dumps(allowed_langs)}/{limit}/{page}")
+        if status != 200:
+            raise NoContent
+        author = Author(data)
+        AUTHOR_CACHE.set(key, author)
+        return author
+
+    @staticmethod
+    def invalidate_cache(author_id: int):
+        AUTHOR_CACHE.invalidate_if(lambda key: key[0] == author_id)
+
+    @staticmethod
+    async def search_raw(query: str, allowed_langs: List[str], limit: int, page: int) -> Optional[dict]:
+        status, data = await FlibustaClient.get_json(
+            "search", f"/author/search/{json.dumps(allowed_langs)}/{limit}/{page}/{query}")
+        if status != 200:
+            return None
+        return data
 
     @staticmethod
     async def search(query: str, allowed_langs: List[str], limit: int, page: int) -> Optional[AuthorSearchResult]:
-        async with aiohttp.request(
-                "GET",
-                f"{Config.FLIBUSTA_SERVER}/author/search/{json.dumps(allowed_langs)}/{limit}/{page}/{query}") \
-                    as response:
-            if response.status != 200:
-                return None
-            return AuthorSearchResult(await response.json())
+        data = await Author.search_raw(query, allowed_langs, limit, page)
+        if data is None:
+            return None
+        return AuthorSearchResult(data)
 
     @staticmethod
     async def get_random(allowed_langs: List[str]) -> "Author":
-        async with aiohttp.request(
-                "GET",
-                f"{Config.FLIBUSTA_SERVER}/author/random/{json.dumps(allowed_langs)}") as response:
-            if response.status != 200:
-                raise NoContent
-            return Author(await response.json())
+        status, data = await FlibustaClient.get_json("random", f"/author/random/{json.dumps(allowed_langs)}")
+        if status != 200:
+            raise NoContent
+        return Author(data)
 
 
 class Book:
-    def __init__(self, obj: dict):
-        self.obj = obj
-
-    def __del__(self):
-        del self.obj
-
-    @property
-    def id(self):
-        return self.obj["id"]
-
-    @property
-    def title(self):
-        return self.obj["title"]
+    __slots__ = ("id", "title", "lang", "file_type", "annotation_exists", "authors", "_caption")
 
-    @property
-    def lang(self):
-        return self.obj["lang"]
-
-    @property
-    def file_type(self):
-        return self.obj["file_type"]
-
-    @property
-    def annotation_exists(self):
-        return self.obj["annotation_exists"]
+    def __init__(self, obj: dict):
+        self.id = obj["id"]
+        self.title = obj["title"]
+        self.lang = obj["lang"]
+        self.file_type = obj["file_type"]
+        self.annotation_exists = obj.get("annotation_exists")
+        self.authors: Optional[List[Author]] = [Author(a) for a in obj["authors"]] if obj.get("authors", None) \
+            else None
 
-    @property
-    def authors(self):
-        return [Author(a) for a in self.obj["authors"]] if self.obj.get("authors", None) else None
+        self._caption = None
 
     @property
     def caption(self) -> str:
-        if not self.authors:
-            return self.title
-
-        authors_text = '\n'.join([author.normal_name for author in self.authors[:15]])
-        if len(self.authors) > 15:
-            authors_text += "\n" + "и т.д."
-        return self.title + '\n' + authors_text
+        if self._caption is None:
+            if not self.authors:
+                self._caption = self.title
+            else:
+                authors_text = '\n'.join([author.normal_name for author in self.authors[:15]])
+                if len(self.authors) > 15:
+                    authors_text += "\n" + "и т.д."
+                self._caption = self.title + '\n' + authors_text
+        return self._caption
 
     def download_caption(self, file_type) -> str:
         return self.caption + f'\n\n⬇ <a href="{self.get_public_download_link(file_type)}">Скачать</a>'
 
     @property
     def short_info(self) -> str:
-        return f"{self.title} \n {' '.join([a.short for a in self.authors])}"
+        return f"{self.title} \n {' '.join([a.short for a in self.authors or []])}"
 
     @property
     def share_text(self) -> str:
@@ -280,6 +443,20 @@ class Book:
         markup.add(InlineKeyboardButton('Скачать', url=self.get_download_link(file_type)))
         return markup
 
+    @property
+    def download_commands(self) -> str:
+        if self.file_type == 'fb2':
+            file_types = ('fb2', 'epub', 'mobi')
+            if not TOO_BIG_FILES:
+                return f'⬇ fb2: /fb2_{self.id}\n⬇ epub: /epub_{self.id}\n⬇ mobi: /mobi_{self.id}\n\n'
+        else:
+            file_types = (self.file_type, )
+            if not TOO_BIG_FILES:
+                return f'⬇ {self.file_type}: /{self.file_type}_{self.id}\n\n'
+        return ''.join(f'⬇ {file_type}: /{file_type}_{self.id}'
+                       f'{LARGE_FILE_HINT if (self.id, file_type) in TOO_BIG_FILES else ""}\n'
+                       for file_type in file_types) + '\n'
+
     @property
     def to_send_book(self) -> str:
         res = f'📖 <b>{self.title}</b> | {self.lang}\n'
@@ -292,45 +469,95 @@ class Book:
                 res += "  и другие\n\n"
         else:
             res += '\n'
-        if self.file_type == 'fb2':
-            return res + f'⬇ fb2: /fb2_{self.id}\n⬇ epub: /epub_{self.id}\n⬇ mobi: /mobi_{self.id}\n\n'
-        else:
-            return res + f'⬇ {self.file_type}: /{self.file_type}_{self.id}\n\n'
+        return res + self.download_commands
 
     @property
     def to_send_book_without_author(self) -> str:
         res = f'📖 <b>{self.title}</b> | {self.lang}\n'
         if self.annotation_exists:
             res += f"Аннотация: /b_info_{self.id}\n"
-        if self.file_type == 'fb2':
-            return res + f'⬇ fb2: /fb2_{self.id}\n⬇ epub: /epub_{self.id}\n⬇ mobi: /mobi_{self.id}\n\n'
-        else:
-            return res + f'⬇ {self.file_type}: /{self.file_type}_{self.id}\n\n'
+        return res + self.download_commands
 
     @staticmethod
     async def get_by_id(book_id: int) -> "Book":
-        async with aiohttp.request("GET", f"{Config.FLIBUSTA_SERVER}/book/{book_id}") as response:
-            if response.status == 204:
-                raise NoContent
-            return Book(await response.json())
+        book = BOOK_CACHE.get(book_id)
+        if book is not None:
+            return book
+        if Book.is_missing(book_id):
+            raise NoContent
+        book = await asyncio.shield(BookBatcher.load(book_id))
+        BOOK_CACHE.set(book_id, book)
+        return book
+
+    @staticmethod
+    async def get_many(book_ids: List[int]) -> Dict[int, "Book"]:
+        books = {}
+        missing = []
+        for book_id in book_ids:
+            book = BOOK_CACHE.get(book_id)
+            if book is None:
+                missing.append(book_id)
+            else:
+                books[book_id] = book
+        if missing:
+            fetched = await BookBatcher.fetch(missing)
+            for book_id, book in fetched.items():
+                if book is None:
+                    MISSING_BOOK_CACHE.set(book_id, True)
+                else:
+                    BOOK_CACHE.set(book_id, book)
+                    books[book_id] = book
+        return books
+
+    @staticmethod
+    def is_missing(book_id: int) -> bool:
+        return MISSING_BOOK_CACHE.get(book_id, False)
+
+    @staticmethod
+    def is_unavailable(book_id: int, file_type: str) -> bool:
+        return UNAVAILABLE_FILE_CACHE.get((book_id, file_type), False)
+
+    @staticmethod
+    def is_too_big(book_id: int, file_type: str) -> bool:  # only as far as a probe or a download has found out
+        return (book_id, file_type) in TOO_BIG_FILES
+
+    @staticmethod
+    def remember_size(book_id: int, file_type: str, size: int):
+        FILE_SIZE_CACHE.set((book_id, file_type), size)
+        if size > TELEGRAM_FILE_SIZE_LIMIT:
+            TOO_BIG_FILES.set((book_id, file_type), True)
+        else:
+            TOO_BIG_FILES.invalidate((book_id, file_type))
+
+    @staticmethod
+    def invalidate_cache(book_id: int):
+        BOOK_CACHE.invalidate(book_id)
+        MISSING_BOOK_CACHE.invalidate(book_id)
+        UNAVAILABLE_FILE_CACHE.invalidate_if(lambda key: key[0] == book_id)
+        FILE_SIZE_CACHE.invalidate_if(lambda key: key[0] == book_id)
+        TOO_BIG_FILES.invalidate_if(lambda key: key[0] == book_id)
+
+    @staticmethod
+    async def search_raw(query: str, allowed_langs: List[str], limit: int, page: int) -> Optional[dict]:
+        status, data = await FlibustaClient.get_json(
+            "search", f"/book/search/{json.dumps(allowed_langs)}/{limit}/{page}/{query}")
+        if status != 200:
+            return None
+        return data
 
     @staticmethod
     async def search(query: str, allowed_langs: List[str], limit: int, page: int) -> Optional[BookSearchResult]:
-        async with aiohttp.request(
-            "GET",
-                f"{Config.FLIBUSTA_SERVER}/book/search/{json.dumps(allowed_langs)}/{limit}/{page}/{query}"
-        ) as response:
-            if response.status != 200:
-                return None
-            return BookSearchResult(await response.json())
+        data = await Book.search_raw(query, allowed_langs, limit, page)
+        if data is None:
+            return None
+        return BookSearchResult(data)
 
     @staticmethod
     async def get_random(allowed_langs: List[str]) -> "Book":
-        async with aiohttp.request("GET", 
-                                   f"{Config.FLIBUSTA_SERVER}/book/random/{json.dumps(allowed_langs)}") as response:
-            if response.status != 200:
-                raise NoContent
-            return Book(await response.json())
+        status, data = await FlibustaClient.get_json("random", f"/book/random/{json.dumps(allowed_langs)}")
+        if status != 200:
+            raise NoContent
+        return Book(data)
 
     def get_download_link(self, file_type: str) -> str:
         return f"{Config.FLIBUSTA_SERVER}/book/download/{self.id}/{file_type}"
@@ -339,43 +566,190 @@ class Book:
         return f"{Config.FLIBUSTA_SERVER_PUBLIC}/book/download/{self.id}/{file_type}"
 
     @staticmethod
-    async def download(book_id: int, file_type: str) -> Optional[BytesResult]:
+    async def probe_size(book_id: int, file_type: str) -> Optional[int]:  # None if the server doesn't tell
+        size = FILE_SIZE_CACHE.get((book_id, file_type))
+        if size is not None:
+            return size
+        breaker = FlibustaClient.breakers["download"]
+        # a half-open breaker's single trial belongs to a download, a probe must not take it
+        if Book.is_unavailable(book_id, file_type) or breaker.state != breaker.CLOSED:
+            return None
+        start = time.monotonic()
+        status = "error"
         try:
-            async with aiohttp.ClientSession(timeout=ClientTimeout(total=600)) as session:
-                async with session.get(f"{Config.FLIBUSTA_SERVER}/book/download/{book_id}/{file_type}",
-                                       timeout=None) as response:
-                    if response.status != 200:
-                        return None
-                    return BytesResult(await response.content.read())
-        except ServerDisconnectedError:
+            async with FlibustaClient.head(f"/book/download/{book_id}/{file_type}",
+                                           timeout=ClientTimeout(total=SIZE_PROBE_TIMEOUT)) as response:
+                status = response.status
+                if response.status >= 500:
+                    breaker.record_failure()
+                if response.status != 200:  # anything but a missing format leaves the size unknown
+                    if response.status in MISSING_FILE_STATUSES:
+                        UNAVAILABLE_FILE_CACHE.set((book_id, file_type), True)
+                    return None
+                if response.content_length is None:
+                    return None
+                Book.remember_size(book_id, file_type, response.content_length)
+                return response.content_length
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            breaker.record_failure()
+            return None  # the download itself will find out
+        finally:
+            REQUEST_DURATION.observe(time.monotonic() - start, endpoint="probe")
+            RESPONSES.inc(endpoint="probe", status=status)
+
+    @staticmethod
+    async def download(book_id: int, file_type: str) -> Optional[DownloadResult]:
+        if Book.is_unavailable(book_id, file_type):
             return None
+        breaker = FlibustaClient.breakers["download"]
+        if not breaker.allow():
+            raise ServiceUnavailable
+        result = DownloadResult()
+        start = time.monotonic()
+        status = "error"
+        try:
+            async with FlibustaClient.get(f"/book/download/{book_id}/{file_type}",
+                                          timeout=ClientTimeout(total=600)) as response:
+                status = response.status
+                if response.status < 500:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+                if response.status != 200:
+                    if response.status in MISSING_FILE_STATUSES:  # not worth retrying for a while
+                        UNAVAILABLE_FILE_CACHE.set((book_id, file_type), True)
+                    result.close()
+                    return None
+                if response.content_length is not None:
+                    Book.remember_size(book_id, file_type, response.content_length)
+                    if response.content_length > TELEGRAM_FILE_SIZE_LIMIT:
+                        status = "too_big"
+                        raise FileTooBig
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    result.write(chunk)
+                    if result.size > TELEGRAM_FILE_SIZE_LIMIT:
+                        Book.remember_size(book_id, file_type, result.size)  # at least this much
+                        status = "too_big"
+                        raise FileTooBig
+                Book.remember_size(book_id, file_type, result.size)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            breaker.record_failure()
+            result.close()
+            raise ServiceUnavailable
+        except BaseException:
+            result.close()
+            raise
+        finally:
+            REQUEST_DURATION.observe(time.monotonic() - start, endpoint="download")
+            RESPONSES.inc(endpoint="download", status=status)
+            RESPONSE_SIZE.observe(result.size, endpoint="download")
+        return result
+
+
+class BookBatcher:  # merges concurrent Book.get_by_id calls into /book/bulk requests
+    WINDOW = 0.005
+    MAX_BATCH_SIZE = 100
+    FALLBACK_CONCURRENCY = 10
+
+    bulk_supported: Optional[bool] = None
+
+    pending: Dict[int, asyncio.Future] = {}
+    flush_handle: Optional[asyncio.TimerHandle] = None
+    resolve_tasks: Set[asyncio.Task] = set()
+
+    batches: int = 0
+    batched_requests: int = 0
+
+    @classmethod
+    def load(cls, book_id: int) -> asyncio.Future:
+        future = cls.pending.get(book_id)
+        if future is not None:
+            return future
+        loop = asyncio.get_event_loop()
+        future = cls.pending[book_id] = loop.create_future()
+        if len(cls.pending) >= cls.MAX_BATCH_SIZE:
+            cls._flush()
+        elif cls.flush_handle is None:
+            cls.flush_handle = loop.call_later(cls.WINDOW, cls._flush)
+        return future
+
+    @classmethod
+    def _flush(cls):
+        if cls.flush_handle is not None:
+            cls.flush_handle.cancel()
+            cls.flush_handle = None
+        batch, cls.pending = cls.pending, {}
+        task = asyncio.ensure_future(cls._resolve(batch))
+        cls.resolve_tasks.add(task)  # the loop only keeps weak references to tasks
+        task.add_done_callback(cls.resolve_tasks.discard)
+
+    @classmethod
+    async def _resolve(cls, batch: Dict[int, asyncio.Future]):
+        cls.batches += 1
+        cls.batched_requests += len(batch)
+        try:
+            books = await cls.fetch(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for book_id, future in batch.items():
+            if future.done():
+                continue
+            book = books.get(book_id)
+            if book is not None:
+                future.set_result(book)
+            elif book_id in books:
+                MISSING_BOOK_CACHE.set(book_id, True)
+                future.set_exception(NoContent())
+            else:
+                future.set_exception(ServiceUnavailable())
+
+    @classmethod
+    async def fetch(cls, book_ids: List[int]) -> Dict[int, Optional[Book]]:
+        # None: the server has no such book, a book left out could not be fetched (rate limit, auth, 5xx)
+        if len(book_ids) > 1 and cls.bulk_supported is not False:
+            status, data = await FlibustaClient.get_json("book_bulk", f"/book/bulk/{json.dumps(book_ids)}")
+            if status == 200:
+                cls.bulk_supported = True
+                books: Dict[int, Optional[Book]] = dict.fromkeys(book_ids)
+                books.update((book.id, book) for book in (Book(obj) for obj in data["result"]))
+                return books
+            if status in (404, 405):
+                cls.bulk_supported = False
+
+        semaphore = asyncio.Semaphore(cls.FALLBACK_CONCURRENCY)
+
+        async def fetch_one(book_id: int) -> Tuple[int, Optional[Book]]:
+            async with semaphore:
+                status, data = await FlibustaClient.get_json("book", f"/book/{book_id}")
+            return status, Book(data) if status == 200 else None
+
+        results = await asyncio.gather(*[fetch_one(book_id) for book_id in book_ids])
+        return {book_id: book for book_id, (status, book) in zip(book_ids, results)
+                if status == 200 or status in MISSING_BOOK_STATUSES}
 
 
 class Sequence:
+    __slots__ = ("count", "id", "name", "books", "authors")
+
     def __init__(self, obj, count=None):
-        self.obj = obj
         self.count = count
 
-    def __bool__(self):
-        return self.count != 0
-
-    @property
-    def id(self):
-        return self.obj['id']
-
-    @property
-    def name(self):
-        return self.obj['name']
+        if not obj:
+            self.id = self.name = None
+            self.books = []
+            self.authors = []
+            return
 
-    @property
-    def books(self) -> List[Book]:
-        if not self.obj:
-            return []
-        return [Book(x) for x in self.obj['books']] if self.obj['books'] else []
+        self.id = obj['id']
+        self.name = obj['name']
+        self.books: List[Book] = [Book(x) for x in obj['books']] if obj.get('books') else []
+        self.authors: List[Author] = [Author(x) for x in obj['authors']] if obj.get('authors') else []
 
-    @property
-    def authors(self) -> List[Author]:
-        return [Author(x) for x in self.obj['authors']] if self.obj['authors'] else []
+    def __bool__(self):
+        return self.count != 0
 
     @property
     def to_send(self) -> str:
@@ -392,128 +766,223 @@ class Sequence:
 
     @staticmethod
     async def get_by_id(seq_id: int, allowed_langs: List[str], limit: int, page: int) -> 'Sequence':
-        async with aiohttp.request(
-                "GET",
-                f"{Config.FLIBUSTA_SERVER}/sequence/{seq_id}/{json.dumps(allowed_langs)}/{limit}/{page}") as response:
-            if response.status != 200:
-                return Sequence(None, 0)
-            response_json = await response.json()
-            return Sequence(response_json["result"], response_json["count"])
+        key = (seq_id, tuple(allowed_langs), limit, page)
+        sequence = SEQUENCE_CACHE.get(key)
+        if sequence is not None:
+            return sequence
+        status, data = await FlibustaClient.get_json(
+            "sequence", f"/sequence/{seq_id}/{json.dumps(allowed_langs)}/{limit}/{page}")
+        if status != 200:
+            return Sequence(None, 0)
+        sequence = Sequence(data["result"], data["count"])
+        SEQUENCE_CACHE.set(key, sequence)
+        return sequence
+
+    @staticmethod
+    def invalidate_cache(seq_id: int):
+        SEQUENCE_CACHE.invalidate_if(lambda key: key[0] == seq_id)
+
+    @staticmethod
+    async def search_raw(query: str, allowed_langs: List[str], limit: int, page: int) -> Optional[dict]:
+        status, data = await FlibustaClient.get_json(
+            "search", f"/sequence/search/{json.dumps(allowed_langs)}/{limit}/{page}/{query}")
+        if status != 200:
+            return None
+        return data
 
     @staticmethod
     async def search(query: str, allowed_langs: List[str], limit: int, page: int) -> Optional[SequenceSearchResult]:
-        async with aiohttp.request(
-                "GET",
-                f"{Config.FLIBUSTA_SERVER}/sequence/search/{json.dumps(allowed_langs)}/{limit}/{page}/{query}"
-        ) as response:
-            if response.status != 200:
-                return None
-            return SequenceSearchResult(await response.json())
+        data = await Sequence.search_raw(query, allowed_langs, limit, page)
+        if data is None:
+            return None
+        return SequenceSearchResult(data)
 
     @staticmethod
     async def get_random(allowed_langs: List[str]) -> "Sequence":
-        async with aiohttp.request("GET", f"{Config.FLIBUSTA_SERVER}/sequence/random/{json.dumps(allowed_langs)}"
-                                   ) as response:
-            if response.status != 200:
-                raise NoContent
-            return Sequence(await response.json())
+        status, data = await FlibustaClient.get_json("random", f"/sequence/random/{json.dumps(allowed_langs)}")
+        if status != 200:
+            raise NoContent
+        return Sequence(data)
 
 
-class BookAnnotation:
-    def __init__(self, obj):
-        self.obj = obj
+class Annotation:
+    __slots__ = ("title", "raw_body", "file", "_body", "_chunks")
 
-    @property
-    def book_id(self):
-        return self.obj["book_id"]
+    PHOTO_URL: str
 
-    @property
-    def title(self):
-        return self.obj.get("title", "")
+    SANITIZE_PATTERN = re.compile(r'<p class="book">|<p class=book>|</p>|<a>|</a>|</A>|\[b\]|\[/b\]')
+
+    def __init__(self, obj):
+        self.title = obj.get("title", "")
+        self.raw_body = obj.get("body", "")
+        self.file = obj.get("file")
+
+        self._body = None
+        self._chunks = {}
 
     @property
     def body(self):
-        return self.obj.get("body", "").replace('<p class="book">', "").replace('</p>', "").replace(
-            "<p class=book>", "").replace("<a>", "").replace("</a>", "").replace("</A>", "").replace(
-            "[b]", "").replace("[/b]", "")
+        if self._body is None:
+            self._body = self.SANITIZE_PATTERN.sub("", self.raw_body)
+        return self._body
 
     @property
     def photo_link(self):
-        if not self.obj.get("file"):
+        if not self.file:
             return None
-        return f"https://flibusta.is/ib/{self.obj['file']}"
+        return f"{self.PHOTO_URL}/{self.file}"
 
     @property
     def to_send(self):
         return f"{self.title} {self.body}"
 
-    @staticmethod
-    async def get_by_book_id(book_id: int):
-        async with aiohttp.request("GET", f"{Config.FLIBUSTA_SERVER}/annotation/book/{book_id}") as response:
-            if response.status != 200:
-                raise NoContent
-            return BookAnnotation(await response.json())
+    def get_chunks(self, first_chunk_size: int) -> List[str]:
+        chunks = self._chunks.get(first_chunk_size)
+        if chunks is None:
+            text = self.to_send
+            chunks = [text[:first_chunk_size]] + [
+                text[i:i + MESSAGE_LENGTH_LIMIT] for i in range(first_chunk_size, len(text), MESSAGE_LENGTH_LIMIT)
+            ]
+            self._chunks[first_chunk_size] = chunks
+        return chunks
+
 
+class BookAnnotation(Annotation):
+    __slots__ = ("book_id", )
+
+    PHOTO_URL = "https://flibusta.is/ib"
 
-class AuthorAnnotation:
     def __init__(self, obj):
-        self.obj = obj
+        super().__init__(obj)
+        self.book_id = obj["book_id"]
 
-    @property
-    def author_id(self):
-        return self.obj["author_id"]
+    @staticmethod
+    async def get_by_book_id(book_id: int):
+        annotation = BOOK_ANNOTATION_CACHE.get(book_id)
+        if annotation is not None:
+            return annotation
+        status, data = await FlibustaClient.get_json("annotation", f"/annotation/book/{book_id}")
+        if status != 200:
+            raise NoContent
+        annotation = BookAnnotation(data)
+        BOOK_ANNOTATION_CACHE.set(book_id, annotation)
+        return annotation
 
-    @property
-    def title(self):
-        return self.obj.get("title", "")
 
-    @property
-    def body(self):
-        return self.obj.get("body", "").replace('<p class="book">', "").replace('</p>', "").replace(
-            "<p class=book>", "").replace("<a>", "").replace("</a>", "").replace("</A>", "").replace(
-            "[b]", "").replace("[/b]", "")
+class AuthorAnnotation(Annotation):
+    __slots__ = ("author_id", )
 
-    @property
-    def photo_link(self):
-        if not self.obj.get("file"):
-            return None
-        return f"https://flibusta.is/ia/{self.obj['file']}"
+    PHOTO_URL = "https://flibusta.is/ia"
 
-    @property
-    def to_send(self):
-        return f"{self.title} {self.body}"
+    def __init__(self, obj):
+        super().__init__(obj)
+        self.author_id = obj["author_id"]
 
     @staticmethod
     async def get_by_author_id(book_id: int):
-        async with aiohttp.request("GET", f"{Config.FLIBUSTA_SERVER}/annotation/author/{book_id}") as response:
-            if response.status != 200:
-                raise NoContent
-            return AuthorAnnotation(await response.json())
+        annotation = AUTHOR_ANNOTATION_CACHE.get(book_id)
+        if annotation is not None:
+            return annotation
+        status, data = await FlibustaClient.get_json("annotation", f"/annotation/author/{book_id}")
+        if status != 200:
+            raise NoContent
+        annotation = AuthorAnnotation(data)
+        AUTHOR_ANNOTATION_CACHE.set(book_id, annotation)
+        return annotation
 
 
 class UpdateLog:
-    books: List[Book]
+    __slots__ = ("count", "books")
 
-    def __init__(self, obj: dict):
-        self.count = obj['count']
+    DAY_PAGE_SIZE = 500
+    FETCH_CONCURRENCY = 5
+
+    def __init__(self, count: int, books: List[Book]):
+        self.count = count
+        self.books = books
 
-        if self.count != 0:
-            self.books = [Book(b) for b in obj["result"]]
-        else:
-            self.books = []
-    
     def __bool__(self):
         return self.count != 0
 
+    @staticmethod
+    async def get_day(day: date, lang: str) -> Optional[List[Book]]:
+        key = (day, lang)
+        books = UPDATE_LOG_DAY_CACHE.get(key)
+        if books is not None:
+            return books
+
+        books = []
+        page = 1
+        while True:
+            status, data = await FlibustaClient.get_json(
+                "update_log",
+                f"/book/update_log_range/{day.isoformat()}/{day.isoformat()}/{json.dumps([lang])}/"
+                f"{UpdateLog.DAY_PAGE_SIZE}/{page}"
+            )
+            if status == 204:
+                break
+            if status != 200:
+                return None
+            if data["count"] == 0 or not data["result"]:
+                break
+            books.extend(Book(obj) for obj in data["result"])
+            if len(books) >= data["count"]:
+                break
+            page += 1
+
+        # past days never change, so they are kept until evicted
+        UPDATE_LOG_DAY_CACHE.set(key, books, ttl=None if day < date.today() else UPDATE_LOG_TODAY_TTL)
+        return books
+
+    @staticmethod
+    async def get_range(start_date: date, end_date: date, allowed_langs: List[str]) -> Optional[List[Book]]:
+        key = (start_date, end_date, tuple(sorted(allowed_langs)))
+        books = UPDATE_LOG_RANGE_CACHE.get(key)
+        if books is not None:
+            return books
+
+        semaphore = asyncio.Semaphore(UpdateLog.FETCH_CONCURRENCY)
+
+        async def get_day(day: date, lang: str) -> Optional[List[Book]]:
+            async with semaphore:
+                return await UpdateLog.get_day(day, lang)
+
+        days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+        results = await asyncio.gather(*[get_day(day, lang) for day in days for lang in key[2]])
+        if any(result is None for result in results):
+            return None
+
+        unique_books = {book.id: book for result in results for book in result}
+        books = sorted(unique_books.values(), key=lambda book: book.id, reverse=True)
+        UPDATE_LOG_RANGE_CACHE.set(key, books)
+        return books
+
     @staticmethod
     async def get_by_day(start_date: date, end_date: date, 
                          allowed_langs: List[str], limit: int, page: int) -> Optional["UpdateLog"]:
-        start_date = start_date.isoformat()
-        end_date = end_date.isoformat()
-        async with aiohttp.request(
-            "GET", 
-            f"{Config.FLIBUSTA_SERVER}/book/update_log_range/{start_date}/{end_date}/{json.dumps(allowed_langs)}/{limit}/{page}"
-                ) as response:
-            if response.status != 200:
-                return None
-            return UpdateLog(await response.json())
+        books = await UpdateLog.get_range(start_date, end_date, allowed_langs)
+        if books is None:
+            return None
+        return UpdateLog(len(books), books[(page - 1) * limit:page * limit])
+
+
+metrics.counter("flibusta_connections_total", "Flibusta client connections by how they were obtained", ["kind"],
+                callback=lambda: {("created", ): FlibustaClient.connections_created,
+                                  ("reused", ): FlibustaClient.connections_reused})
+metrics.counter("flibusta_retries_total", "Retried flibusta server requests",
+                callback=lambda: {(): FlibustaClient.retries})
+metrics.counter("flibusta_hedged_requests_total", "Hedged duplicate flibusta server requests",
+                callback=lambda: {(): FlibustaClient.hedged_requests})
+metrics.gauge("flibusta_circuit_breaker_state", "Current state of the flibusta circuit breakers",
+              ["endpoint", "state"],
+              callback=lambda: {(endpoint, state): int(breaker.state == state)
+                                for endpoint, breaker in FlibustaClient.breakers.items()
+                                for state in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN)})
+metrics.counter("flibusta_circuit_breaker_opened_total", "How many times the flibusta circuit breakers opened",
+                ["endpoint"],
+                callback=lambda: {(endpoint, ): breaker.opened_count
+                                  for endpoint, breaker in FlibustaClient.breakers.items()})
+metrics.counter("flibusta_book_batches_total", "Batched book metadata lookups",
+                callback=lambda: {(): BookBatcher.batches})
+metrics.counter("flibusta_book_batched_requests_total", "Book ids resolved through batched lookups",
+                callback=lambda: {(): BookBatcher.batched_requests})
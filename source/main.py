@@ -1,20 +1,32 @@
 import re
 from datetime import date, timedelta
 
-from aiogram import Bot, Dispatcher, types, filters, exceptions
-from aiogram.utils.executor import start_webhook
+from aiogram import Dispatcher, types, filters, exceptions
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+from aiogram.utils.executor import set_webhook
+from aiohttp import web
 
 import analytics
 import strings
+from metrics import metrics_handler
+from notifier import ChatActions
 from filters import CallbackDataRegExFilter, InlineQueryRegExFilter, IsTextMessageFilter
 from config import Config
-from flibusta_server import Book, NoContent
-from send import Sender
+from flibusta_server import Book, NoContent, FlibustaClient
+from resilience import ServiceUnavailable
+from send import Sender, RenderedPageCache, SettingsCache
+from random_pool import RandomPool
+from redis_client import RedisClient
+from scheduled_bot import ScheduledBot
+from prewarmer import Prewarmer
+from transfer_pool import TransferPool
 from db import *
 from utils import ignore, make_settings_keyboard
 
 
-bot = Bot(token=Config.BOT_TOKEN)
+bot = ScheduledBot(token=Config.BOT_TOKEN,
+                   server=TelegramAPIServer.from_base(Config.TELEGRAM_API_SERVER) if Config.TELEGRAM_API_SERVER
+                   else TELEGRAM_PRODUCTION)
 dp = Dispatcher(bot)
 
 Sender.configure(bot)
@@ -64,7 +76,8 @@ async def vote_handler(msg: types.Message):
 async def settings(msg: types.Message):
     async with analytics.Analyze("settings", msg):
         await TelegramUserDB.create_or_update(msg)
-        await msg.reply("Настройки: ", reply_markup=await make_settings_keyboard(msg.from_user.id))
+        settings = await SettingsCache.get(msg.from_user.id)
+        await msg.reply("Настройки: ", reply_markup=await make_settings_keyboard(msg.from_user.id, settings))
 
 
 @dp.callback_query_handler(CallbackDataRegExFilter(r"^(ru|uk|be)_(on|off)$"))
@@ -73,7 +86,7 @@ async def settings(msg: types.Message):
 async def lang_setup(query: types.CallbackQuery):
     async with analytics.Analyze("settings_change", query):
         await TelegramUserDB.create_or_update(query)
-        settings = await SettingsDB.get(query.from_user.id)
+        settings = await SettingsCache.get(query.from_user.id)
         lang, set_ = query.data.split('_')
         if lang == "uk":
             settings.allow_uk = (set_ == "on")
@@ -81,8 +94,8 @@ async def lang_setup(query: types.CallbackQuery):
             settings.allow_be = (set_ == "on")
         if lang == "ru":
             settings.allow_ru = (set_ == "on")
-        await SettingsDB.update(settings)
-        keyboard = await make_settings_keyboard(query.from_user.id)
+        await SettingsCache.update(settings)
+        keyboard = await make_settings_keyboard(query.from_user.id, settings)
         await bot.edit_message_reply_markup(chat_id=query.message.chat.id, message_id=query.message.message_id,
                                             reply_markup=keyboard)
 
@@ -307,22 +320,50 @@ async def share_book(query: types.InlineQuery):
         )])
 
 
+@dp.errors_handler(exception=ServiceUnavailable)
+@ignore(exceptions.BotBlocked)
+@ignore(exceptions.BadRequest)
+async def service_unavailable_handler(update: types.Update, exception: ServiceUnavailable):
+    if update.message:
+        await update.message.reply(strings.service_unavailable)
+    elif update.callback_query:
+        await bot.answer_callback_query(update.callback_query.id, strings.service_unavailable, show_alert=True)
+    return True
+
+
 async def on_startup(dp):
     await prepare_db()
+    TelegramUserDB.start()
+    await FlibustaClient.configure()
+    await RedisClient.configure()
+    RandomPool.start()
+    TransferPool.start()
+    RenderedPageCache.start()
+    Prewarmer.start()
     await bot.set_webhook(Config.WEBHOOK_HOST + "/")
 
 
 async def on_shutdown(dp):
     await bot.delete_webhook()
+    await RandomPool.stop()
+    await Prewarmer.stop()
+    await RenderedPageCache.stop()
+    await TransferPool.stop()
+    await TelegramUserDB.stop()
+    await ChatActions.stop()
+    await FlibustaClient.close()
+    await RedisClient.close()
 
 
 if __name__ == "__main__":
-    start_webhook(
+    web_app = web.Application()
+    web_app.router.add_get("/metrics", metrics_handler)
+    executor = set_webhook(
         dispatcher=dp,
         webhook_path="/",
         on_startup=on_startup,
         on_shutdown=on_shutdown,
         skip_updates=False,
-        host=Config.SERVER_HOST,
-        port=Config.SERVER_PORT
+        web_app=web_app
     )
+    executor.run_app(host=Config.SERVER_HOST, port=Config.SERVER_PORT)
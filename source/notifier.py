@@ -1,6 +1,95 @@
 import asyncio
+import heapq
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+
 from aiogram import Bot
 
+import metrics
+from utils import ignore
+
+
+class ChatActions:  # one loop repeats the current action of every busy chat
+    INTERVAL = 4  # Telegram shows an action for 5 seconds
+
+    bot: Optional[Bot] = None
+    chats: Dict[int, Counter] = {}  # chat_id -> action -> how many holders
+    next_send: Dict[int, float] = {}
+    schedule: List[Tuple[float, int]] = []
+
+    task: Optional[asyncio.Task] = None
+    wakeup: Optional[asyncio.Event] = None
+    send_tasks: Set[asyncio.Task] = set()
+
+    sent: int = 0
+
+    @classmethod
+    def add(cls, bot: Bot, chat_id: int, action: str):
+        cls.bot = bot
+        if cls.task is None or cls.task.done():
+            cls.wakeup = asyncio.Event()
+            cls.task = asyncio.ensure_future(cls._loop())
+        actions = cls.chats.get(chat_id)
+        if actions is None:
+            actions = cls.chats[chat_id] = Counter()
+        is_new = action not in actions
+        actions[action] += 1
+        if is_new:  # show the newest action right away
+            cls._schedule(chat_id, time.monotonic())
+            cls.wakeup.set()
+
+    @classmethod
+    async def stop(cls):
+        if cls.task is not None:
+            cls.task.cancel()
+            try:
+                await cls.task
+            except asyncio.CancelledError:
+                pass
+            cls.task = None
+
+    @classmethod
+    def remove(cls, chat_id: int, action: str):
+        actions = cls.chats[chat_id]
+        actions[action] -= 1
+        if actions[action] == 0:
+            del actions[action]
+        if not actions:
+            del cls.chats[chat_id]
+            del cls.next_send[chat_id]
+
+    @classmethod
+    def _schedule(cls, chat_id: int, when: float):
+        cls.next_send[chat_id] = when
+        heapq.heappush(cls.schedule, (when, chat_id))
+
+    @classmethod
+    @ignore(Exception)
+    async def _send(cls, chat_id: int, action: str):
+        await cls.bot.send_chat_action(chat_id, action)
+
+    @classmethod
+    async def _loop(cls):
+        while True:
+            now = time.monotonic()
+            while cls.schedule and cls.schedule[0][0] <= now:
+                when, chat_id = heapq.heappop(cls.schedule)
+                if cls.next_send.get(chat_id) != when:  # finished or rescheduled since
+                    continue
+                actions = cls.chats[chat_id]
+                task = asyncio.ensure_future(cls._send(chat_id, next(reversed(actions))))
+                cls.send_tasks.add(task)  # the loop only keeps weak references to tasks
+                task.add_done_callback(cls.send_tasks.discard)
+                cls.sent += 1
+                cls._schedule(chat_id, now + cls.INTERVAL)
+            cls.wakeup.clear()
+            timeout = cls.schedule[0][0] - now if cls.schedule else None
+            try:
+                await asyncio.wait_for(cls.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
 
 class Notifier:
     def __init__(self, bot: Bot, chat_id: int, notification_type: str):
@@ -8,17 +97,12 @@ class Notifier:
         self.chat_id = chat_id
         self.notification_type = notification_type
 
-        self.run = True
-        self.task = None
-
-    async def run_notify_loop(self):
-        while self.run:
-            await self.bot.send_chat_action(self.chat_id, self.notification_type)
-            await asyncio.sleep(3)
-
     async def __aenter__(self):
-        self.task = asyncio.create_task(self.run_notify_loop())
+        ChatActions.add(self.bot, self.chat_id, self.notification_type)
 
     async def __aexit__(self, exc_type, exc_val, ext_tb):
-        self.run = False
-        await self.task
+        ChatActions.remove(self.chat_id, self.notification_type)
+
+
+metrics.gauge("chat_action_chats", "Chats currently shown a chat action", callback=lambda: {(): len(ChatActions.chats)})
+metrics.counter("chat_actions_sent_total", "Chat actions sent", callback=lambda: {(): ChatActions.sent})
@@ -0,0 +1,175 @@
+import asyncio
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import exceptions
+
+import metrics
+from config import Config
+from flibusta_server import Book, UpdateLog, FileTooBig
+from redis_client import RedisClient
+from resilience import ServiceUnavailable
+from send import Sender, FileIdCache, BookPopularity, UploadFailed, normalize
+from transfer_pool import TransferPool
+from utils import ignore
+
+
+class Prewarmer:  # uploads fresh and popular books to the books channel before anybody asks for them
+    LANGS = ["ru", "uk", "be"]
+    CONVERTIBLE_FILE_TYPES = ("fb2", "epub", "mobi")
+    LOCK_KEY = "prewarm:lock"
+    BUDGET_KEY_TTL = 2 * 24 * 60 * 60
+
+    task: Optional[asyncio.Task] = None
+
+    bytes_today: int = 0  # shared by all replicas, as of the last look at redis
+    pending: int = 0
+
+    results: Dict[str, int] = {}
+    bytes_uploaded: int = 0
+
+    @classmethod
+    def start(cls):
+        if Config.FLIBUSTA_BOOKS_CHANNEL_ID is None:
+            return
+        cls.task = asyncio.create_task(cls._loop())
+
+    @classmethod
+    async def stop(cls):
+        if cls.task is not None:
+            cls.task.cancel()
+            try:
+                await cls.task
+            except asyncio.CancelledError:
+                pass
+            cls.task = None
+
+    @staticmethod
+    def make_budget_key(day: date) -> str:
+        return f"prewarm:bytes:{day.isoformat()}"
+
+    @classmethod
+    async def budget_left(cls) -> int:
+        key = cls.make_budget_key(date.today())
+        spent = await RedisClient.run(lambda redis: redis.get(key), default=cls.bytes_today)  # the last known count
+        cls.bytes_today = int(spent or 0)
+        return Config.PREWARM_DAILY_BYTES - cls.bytes_today
+
+    @classmethod
+    async def spend(cls, size: int):
+        key = cls.make_budget_key(date.today())
+
+        def store(redis):
+            pipeline = redis.pipeline()
+            pipeline.incrby(key, size)
+            pipeline.expire(key, cls.BUDGET_KEY_TTL)
+            return pipeline.execute()
+
+        result = await RedisClient.run(store)
+        cls.bytes_today = result[0] if result else cls.bytes_today + size  # counted locally while redis is down
+
+    @classmethod
+    async def _loop(cls):
+        while True:
+            await cls.run_once()
+            await asyncio.sleep(Config.PREWARM_INTERVAL)
+
+    @classmethod
+    @ignore(Exception)
+    async def run_once(cls):
+        if await cls.budget_left() <= 0:
+            return
+        redis = await RedisClient.get()  # one replica per interval, the lock is left to expire
+        if not await redis.set(cls.LOCK_KEY, "1", expire=int(Config.PREWARM_INTERVAL), exist=redis.SET_IF_NOT_EXIST):
+            return
+        today = date.today()
+        book_ids = await BookPopularity.top(Config.PREWARM_TOP_N)
+        update_log = await UpdateLog.get_by_day(today - timedelta(days=1), today, cls.LANGS, Config.PREWARM_TOP_N, 1)
+        if update_log is not None:
+            book_ids += [book.id for book in update_log.books if book.id not in book_ids]
+        books = await Book.get_many(book_ids)
+
+        jobs: List[Tuple[Book, str]] = []
+        for book_id in book_ids:
+            book = books.get(book_id)
+            if book is None:
+                continue
+            file_types = cls.CONVERTIBLE_FILE_TYPES if book.file_type == "fb2" else (book.file_type, )
+            jobs.extend((book, file_type) for file_type in file_types)
+        cached = await FileIdCache.get_many([(book.id, file_type) for book, file_type in jobs])
+        cls.results["cached"] = cls.results.get("cached", 0) + sum(1 for file_id in cached.values() if file_id)
+        jobs = [(book, file_type) for book, file_type in jobs if not cached[(book.id, file_type)]]
+
+        semaphore = asyncio.Semaphore(Config.PREWARM_CONCURRENCY)
+        cls.pending = len(jobs)
+
+        async def warm(book: Book, file_type: str):
+            async with semaphore:
+                result = await cls.warm(book, file_type)
+            cls.results[result] = cls.results.get(result, 0) + 1
+            cls.pending -= 1
+
+        await asyncio.gather(*[warm(book, file_type) for book, file_type in jobs])
+
+    @classmethod
+    async def warm(cls, book: Book, file_type: str) -> str:
+        if await cls.budget_left() <= 0:
+            return "over_budget"
+        if Book.is_unavailable(book.id, file_type):
+            return "unavailable"
+        if Book.is_too_big(book.id, file_type):
+            return "too_big"
+        if await FileIdCache.get(book.id, file_type):
+            return "cached"
+        key = (book.id, file_type)
+        if key in Sender.upload_flights.calls:
+            return "in_flight"
+
+        async def upload():
+            # a worker must never join a user's flight: its leader may be queued behind the warm-up jobs
+            if key in Sender.upload_flights.calls:
+                return None
+            file_id, _ = await Sender.upload_flights.do(key, lambda: cls.upload(book, file_type))
+            return file_id or ""
+
+        try:
+            # the flight is registered only once a worker runs the job, a user never waits behind the warm-up queue
+            file_id = await TransferPool.submit(Config.FLIBUSTA_BOOKS_CHANNEL_ID, upload, TransferPool.WARMUP)
+        except FileTooBig:
+            return "too_big"
+        except (ServiceUnavailable, UploadFailed):
+            return "failed"
+        if file_id is None:
+            return "in_flight"
+        return "uploaded" if file_id else "unavailable"
+
+    @classmethod
+    async def upload(cls, book: Book, file_type: str) -> Optional[str]:
+        file_id = await FileIdCache.get(book.id, file_type)  # a user may have got it while the job was queued
+        if file_id:
+            return file_id
+        book_file = await Book.download(book.id, file_type)
+        if not book_file:
+            return None
+        with book_file:
+            await cls.spend(book_file.size)
+            book_file.name = await normalize(book, file_type)
+            try:
+                response = await Sender.bot.send_document(Config.FLIBUSTA_BOOKS_CHANNEL_ID, book_file.get_input_file(),
+                                                          caption=book.caption, disable_notification=True)
+            except exceptions.TelegramAPIError:
+                raise UploadFailed(Config.FLIBUSTA_BOOKS_CHANNEL_ID)  # a user waiting on this flight retries for itself
+            cls.bytes_uploaded += book_file.size
+        file_id = response.document.file_id
+        await FileIdCache.set(book.id, file_type, file_id)
+        return file_id
+
+
+metrics.counter("prewarm_files_total", "Books considered by the pre-warmer by outcome", ["result"],
+                callback=lambda: {(result, ): count for result, count in Prewarmer.results.items()})
+metrics.counter("prewarm_uploaded_bytes_total", "Bytes uploaded to the books channel by the pre-warmer",
+                callback=lambda: {(): Prewarmer.bytes_uploaded})
+metrics.gauge("prewarm_pending", "Books left in the current pre-warm run",
+              callback=lambda: {(): Prewarmer.pending})
+metrics.gauge("prewarm_budget_left_bytes", "Download bytes the pre-warmer may still use today",
+              callback=lambda: {(): max(Config.PREWARM_DAILY_BYTES - Prewarmer.bytes_today, 0)})
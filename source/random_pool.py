@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import metrics
+from config import Config
+from flibusta_server import Book, Author, Sequence, NoContent
+from resilience import ServiceUnavailable
+
+
+PoolKey = Tuple[str, Tuple[str, ...]]
+
+
+class RandomPool:  # ready-made random items per (kind, allowed languages), topped up in the background
+    SOURCES = {
+        "book": Book.get_random,
+        "author": Author.get_random,
+        "sequence": Sequence.get_random
+    }
+
+    MAX_BACKOFF = 5 * 60
+    ERROR_BACKOFF = 5
+
+    pools: Dict[PoolKey, Deque] = {}
+    failures: Dict[PoolKey, int] = {}
+    retry_at: Dict[PoolKey, float] = {}  # a pool whose source keeps failing is left alone for a while
+
+    task: Optional[asyncio.Task] = None
+    wakeup: Optional[asyncio.Event] = None
+
+    hits: int = 0
+    misses: int = 0
+    refills: int = 0
+
+    @classmethod
+    def start(cls):
+        cls.wakeup = asyncio.Event()
+        cls.task = asyncio.create_task(cls._refill_loop())
+
+    @classmethod
+    async def stop(cls):
+        if cls.task is not None:
+            cls.task.cancel()
+            try:
+                await cls.task
+            except asyncio.CancelledError:
+                pass
+            cls.task = None
+
+    @classmethod
+    async def get(cls, kind: str, allowed_langs: List[str]):
+        key = (kind, tuple(sorted(allowed_langs)))
+        pool = cls.pools.get(key)
+        if pool is None:
+            pool = cls.pools[key] = deque()
+        if cls.wakeup is not None:
+            cls.wakeup.set()
+        if pool:
+            cls.hits += 1
+            return pool.popleft()
+        cls.misses += 1
+        return await cls.SOURCES[kind](list(key[1]))
+
+    @classmethod
+    def _most_empty(cls, now: float) -> Tuple[Optional[Tuple[PoolKey, Deque]], Optional[float]]:
+        candidates = []
+        retry_in = None  # until the first backed off pool may be tried again
+        for key, pool in cls.pools.items():
+            if len(pool) >= Config.RANDOM_POOL_DEPTH:
+                continue
+            delay = cls.retry_at.get(key, 0) - now
+            if delay > 0:
+                retry_in = delay if retry_in is None else min(retry_in, delay)
+            else:
+                candidates.append((key, pool))
+        if not candidates:
+            return None, retry_in
+        return min(candidates, key=lambda item: len(item[1])), None
+
+    @classmethod
+    async def _refill_loop(cls):
+        while True:
+            try:
+                await cls._refill_step()
+            except Exception:  # the loop must outlive any bug in a single step
+                logging.exception("Random pool refill step failed")
+                await asyncio.sleep(cls.ERROR_BACKOFF)
+
+    @classmethod
+    async def _refill_step(cls):
+        now = time.monotonic()
+        candidate, retry_in = cls._most_empty(now)
+        if candidate is None:
+            cls.wakeup.clear()
+            try:
+                await asyncio.wait_for(cls.wakeup.wait(), retry_in)
+            except asyncio.TimeoutError:
+                pass
+            return
+        key, pool = candidate
+        kind, langs = key
+        try:
+            pool.append(await cls.SOURCES[kind](list(langs)))
+            cls.refills += 1
+            cls.failures.pop(key, None)
+            cls.retry_at.pop(key, None)
+        except Exception as e:  # a pool whose source fails in any way is backed off, not retried in a tight loop
+            if not isinstance(e, (NoContent, ServiceUnavailable)):
+                logging.exception("Random pool refill failed for %s", key)
+            cls.failures[key] = cls.failures.get(key, 0) + 1
+            cls.retry_at[key] = time.monotonic() + min(
+                cls.MAX_BACKOFF, 2 ** cls.failures[key] / Config.RANDOM_POOL_REFILL_RATE)
+        await asyncio.sleep(1 / Config.RANDOM_POOL_REFILL_RATE)
+
+
+metrics.counter("random_pool_requests_total", "Random item requests by whether the pool had an item ready",
+                ["result"], callback=lambda: {("hit", ): RandomPool.hits, ("miss", ): RandomPool.misses})
+metrics.counter("random_pool_refills_total", "Random items fetched in the background",
+                callback=lambda: {(): RandomPool.refills})
+metrics.gauge("random_pool_depth", "Random items ready per pool", ["kind", "langs"],
+              callback=lambda: {(kind, ",".join(langs)): len(pool) for (kind, langs), pool in RandomPool.pools.items()})
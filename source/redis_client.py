@@ -0,0 +1,99 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+import aioredis
+from aioredis import ConnectionsPool
+
+import metrics
+from config import Config
+from resilience import RetryPolicy
+
+
+COMMAND_DURATION = metrics.histogram("redis_command_duration_seconds", "Redis command latency", ["command"],
+                                     buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1))
+CONNECT_FAILURES = metrics.counter("redis_connect_failures_total", "Failed attempts to create the redis pool")
+SKIPPED = metrics.counter("redis_skipped_commands_total", "Cache commands given up on because redis failed")
+
+REDIS_ERRORS = (aioredis.RedisError, OSError, asyncio.TimeoutError)
+
+
+class InstrumentedPool(ConnectionsPool):
+    def execute(self, command, *args, **kw):
+        start = time.monotonic()
+        name = (command.decode() if isinstance(command, bytes) else command).upper()
+        result = asyncio.ensure_future(super().execute(command, *args, **kw))
+        result.add_done_callback(lambda _: COMMAND_DURATION.observe(time.monotonic() - start, command=name))
+        return result
+
+
+class RedisClient:
+    pool: Optional[aioredis.Redis] = None
+    lock: Optional[asyncio.Lock] = None
+
+    retry_policy = RetryPolicy(attempts=6, base_delay=0.5, max_delay=10)
+    COMMAND_TIMEOUT = 1
+
+    @classmethod
+    async def configure(cls):
+        cls.lock = asyncio.Lock()
+        await cls._connect()
+
+    @classmethod
+    async def _connect(cls):
+        for attempt in range(cls.retry_policy.attempts):
+            try:
+                cls.pool = await aioredis.create_redis_pool(
+                    Config.REDIS_HOST, password=Config.REDIS_PASSWORD,
+                    minsize=Config.REDIS_POOL_MINSIZE, maxsize=Config.REDIS_POOL_MAXSIZE,
+                    pool_cls=InstrumentedPool
+                )
+                return
+            except (OSError, aioredis.RedisError):
+                CONNECT_FAILURES.inc()
+                if attempt == cls.retry_policy.attempts - 1:
+                    raise
+                await asyncio.sleep(cls.retry_policy.get_delay(attempt))
+
+    @classmethod
+    async def get(cls) -> aioredis.Redis:
+        # the pool replaces broken connections by itself, this only covers a pool that has been closed
+        if cls.pool is None or cls.pool.closed:
+            if cls.lock is None:
+                cls.lock = asyncio.Lock()
+            async with cls.lock:
+                if cls.pool is None or cls.pool.closed:
+                    await cls._connect()
+        return cls.pool
+
+    @classmethod
+    async def run(cls, command: Callable[[aioredis.Redis], Awaitable], default: Any = None) -> Any:
+        # for caches that can do without redis: a failure or a slow answer counts as a miss
+        async def run():
+            return await command(await cls.get())
+
+        try:
+            return await asyncio.wait_for(run(), cls.COMMAND_TIMEOUT)
+        except REDIS_ERRORS:
+            SKIPPED.inc()
+            return default
+
+    @classmethod
+    async def close(cls):
+        if cls.pool is not None:
+            cls.pool.close()
+            await cls.pool.wait_closed()
+            cls.pool = None
+
+
+def _pool_connections() -> dict:
+    pool = RedisClient.pool
+    if pool is None or pool.closed:
+        return {}
+    connections = pool.connection
+    return {("in_use", ): connections.size - connections.freesize, ("free", ): connections.freesize}
+
+
+metrics.gauge("redis_pool_connections", "Redis pool connections by state", ["state"], callback=_pool_connections)
+metrics.gauge("redis_pool_max_connections", "Redis pool size limit",
+              callback=lambda: {(): Config.REDIS_POOL_MAXSIZE})
@@ -0,0 +1,164 @@
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, Hashable, NamedTuple, Optional, Tuple
+
+from aiogram import Bot, exceptions
+from aiogram.bot import api
+
+import metrics
+from cache import TTLCache
+from config import Config
+from resilience import TokenBucket
+
+
+QUEUE_DELAY = metrics.histogram("telegram_queue_delay_seconds", "Time outgoing messages wait for a send slot",
+                                ["priority"], buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+QUEUE_DEPTH = metrics.gauge("telegram_queue_depth", "Outgoing messages waiting for a send slot", ["priority"])
+RETRY_AFTER = metrics.counter("telegram_retry_after_total", "Flood control responses from Telegram", ["method"])
+
+
+class Waiter(NamedTuple):
+    chat_id: Hashable
+    future: asyncio.Future
+    enqueued_at: float
+
+
+class ScheduledBot(Bot):  # every message goes out through token buckets: one for the bot, one per chat
+    INTERACTIVE = 0
+    NORMAL = 1
+    BULK = 2
+    PRIORITY_NAMES = {INTERACTIVE: "interactive", NORMAL: "normal", BULK: "bulk"}
+
+    SCHEDULED_METHODS = {
+        api.Methods.SEND_MESSAGE, api.Methods.SEND_DOCUMENT, api.Methods.SEND_PHOTO, api.Methods.FORWARD_MESSAGE,
+        api.Methods.EDIT_MESSAGE_TEXT, api.Methods.EDIT_MESSAGE_REPLY_MARKUP, api.Methods.EDIT_MESSAGE_CAPTION
+    }
+    INTERACTIVE_METHODS = {
+        api.Methods.EDIT_MESSAGE_TEXT, api.Methods.EDIT_MESSAGE_REPLY_MARKUP, api.Methods.EDIT_MESSAGE_CAPTION
+    }
+    CHAT_BURST = 3
+    MAX_RETRIES = 3
+    GLOBAL_FLOOD_CHATS = 3  # flood control for this many chats within the window means the bot-wide limit
+    GLOBAL_FLOOD_WINDOW = 1
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.global_bucket = TokenBucket(Config.TELEGRAM_GLOBAL_RATE, Config.TELEGRAM_GLOBAL_RATE)
+        self.chat_buckets = TTLCache(max_size=100_000, ttl=60)  # an idle bucket refills within a minute
+        self.waiters: Dict[int, Deque[Waiter]] = {priority: deque() for priority in self.PRIORITY_NAMES}
+        self.paused_until = 0.0
+        self.paused_chats = TTLCache(max_size=100_000)  # chat_id -> paused until
+        self.recent_floods: Deque[Tuple[float, Hashable]] = deque()
+
+        self.wakeup: Optional[asyncio.Event] = None
+        self.dispatcher: Optional[asyncio.Task] = None
+
+    def get_priority(self, method: str, data: Optional[Dict]) -> Optional[int]:
+        if method not in self.SCHEDULED_METHODS or not data or "chat_id" not in data:
+            return None
+        if method in self.INTERACTIVE_METHODS:
+            return self.INTERACTIVE
+        if str(data["chat_id"]) == str(Config.FLIBUSTA_BOOKS_CHANNEL_ID):
+            return self.BULK
+        return self.NORMAL
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        priority = self.get_priority(method, data)
+        chat_id = data.get("chat_id") if data else None
+        for attempt in range(self.MAX_RETRIES + 1):
+            if priority is not None:
+                await self.wait_turn(chat_id, priority)
+            else:
+                delay = max(self.paused_until, self.chat_paused_until(chat_id)) - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            try:
+                return await super().request(method, data, files, **kwargs)
+            except exceptions.RetryAfter as e:
+                RETRY_AFTER.inc(method=method)
+                self.pause(chat_id, e.timeout)
+                if files or attempt == self.MAX_RETRIES:  # uploaded files are consumed, the caller has to resend
+                    raise
+
+    def chat_paused_until(self, chat_id: Optional[Hashable]) -> float:
+        return self.paused_chats.get(chat_id, 0.0) if chat_id is not None else 0.0
+
+    def pause(self, chat_id: Optional[Hashable], timeout: float):
+        now = time.monotonic()
+        until = now + timeout
+        while self.recent_floods and self.recent_floods[0][0] < now - self.GLOBAL_FLOOD_WINDOW:
+            self.recent_floods.popleft()
+        self.recent_floods.append((now, chat_id))
+        chats = {flood_chat_id for _, flood_chat_id in self.recent_floods}
+        if chat_id is None or len(chats) >= self.GLOBAL_FLOOD_CHATS:
+            self.paused_until = max(self.paused_until, until)
+        else:  # a single chat's limit, the other chats go on
+            until = max(self.chat_paused_until(chat_id), until)
+            self.paused_chats.set(chat_id, until, ttl=until - now)
+
+    async def wait_turn(self, chat_id: Hashable, priority: int):
+        if self.dispatcher is None or self.dispatcher.done():
+            self.wakeup = asyncio.Event()
+            self.dispatcher = asyncio.ensure_future(self._dispatch())
+        future = asyncio.get_event_loop().create_future()
+        self.waiters[priority].append(Waiter(chat_id, future, time.monotonic()))
+        QUEUE_DEPTH.inc(priority=self.PRIORITY_NAMES[priority])
+        self.wakeup.set()
+        await future
+
+    def get_chat_bucket(self, chat_id: Hashable) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            try:
+                is_group = int(chat_id) < 0
+            except ValueError:  # @channelusername
+                is_group = True
+            bucket = TokenBucket(Config.TELEGRAM_GROUP_RATE if is_group else Config.TELEGRAM_CHAT_RATE,
+                                 self.CHAT_BURST)
+        self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    def _pick(self, now: float) -> Tuple[Optional[Waiter], Optional[float]]:
+        min_delay = None
+        for priority, waiters in self.waiters.items():
+            index = 0
+            while index < len(waiters):
+                waiter = waiters[index]
+                if waiter.future.done():  # the caller has gone away
+                    del waiters[index]
+                    QUEUE_DEPTH.dec(priority=self.PRIORITY_NAMES[priority])
+                    continue
+                bucket = self.get_chat_bucket(waiter.chat_id)
+                delay = max(bucket.delay(now), self.chat_paused_until(waiter.chat_id) - now)
+                if delay <= 0:
+                    del waiters[index]
+                    QUEUE_DEPTH.dec(priority=self.PRIORITY_NAMES[priority])
+                    QUEUE_DELAY.observe(now - waiter.enqueued_at, priority=self.PRIORITY_NAMES[priority])
+                    bucket.take()
+                    return waiter, None
+                min_delay = delay if min_delay is None else min(min_delay, delay)
+                index += 1
+        return None, min_delay
+
+    async def _dispatch(self):
+        while True:
+            if not any(self.waiters.values()):
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            now = time.monotonic()
+            delay = max(self.paused_until - now, self.global_bucket.delay(now))
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            waiter, delay = self._pick(now)
+            if waiter is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.global_bucket.take()
+            waiter.future.set_result(None)
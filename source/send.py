@@ -1,16 +1,29 @@
+import asyncio
 import typing
-from typing import Optional
+from typing import Optional, Set
 from functools import wraps
-from datetime import date
+from datetime import date, timedelta
 
 import transliterate as transliterate
 from aiogram import Bot, types, exceptions
 from aiogram.bot import api
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, base
 from aiogram.utils.payload import prepare_file, prepare_arg, generate_payload
-import aioredis
-from flibusta_server import Book, Author, Sequence, BookAnnotation, NoContent, AuthorAnnotation, UpdateLog
+from flibusta_server import (Book, Author, Sequence, BookAnnotation, NoContent, AuthorAnnotation, UpdateLog,
+                             FileTooBig, BookSearchResult, AuthorSearchResult, SequenceSearchResult,
+                             CAPTION_LENGTH_LIMIT, MESSAGE_LENGTH_LIMIT)
+import metrics
+from cache import TTLCache
 from notifier import Notifier
+from random_pool import RandomPool
+from redis_client import RedisClient
+from transfer_pool import TransferPool
+from utils import ignore, SingleFlight
+
+try:
+    import ujson as json
+except ImportError:
+    import json
 
 from config import Config
 
@@ -20,6 +33,12 @@ ELEMENTS_ON_PAGE = 7
 BOOKS_CHANGER = 5
 
 
+class UploadFailed(Exception):  # the file was downloaded but telegram refused it in this chat
+    def __init__(self, chat_id: int):
+        super().__init__(chat_id)
+        self.chat_id = chat_id
+
+
 async def get_keyboard(page: int, pages_count: int, keyboard_type: str) -> Optional[InlineKeyboardMarkup]:
     if pages_count == 1:
         return None
@@ -48,18 +67,397 @@ async def get_keyboard(page: int, pages_count: int, keyboard_type: str) -> Optio
     return keyboard
 
 
-async def normalize(book: Book, file_type: str) -> str:  # remove chars that don't accept in Telegram Bot API
-    filename = '_'.join([a.short for a in book.authors]) + '_-_' if book.authors else ''
-    filename += book.title if book.title[-1] != ' ' else book.title[:-1]
-    filename = transliterate.translit(filename, 'ru', reversed=True)
+FILENAME_REMOVED_CHARS = "(),….’!\"?»«':"
+FILENAME_REPLACED_CHARS = (('—', '-'), ('/', '_'), ('№', 'N'), (' ', '_'), ('–', '-'), ('á', 'a'), (' ', '_'))
 
-    for c in "(),….’!\"?»«':":
+
+def clean_filename_chars(filename: str) -> str:  # remove chars that don't accept in Telegram Bot API
+    for c in FILENAME_REMOVED_CHARS:
         filename = filename.replace(c, '')
 
-    for c, r in (('—', '-'), ('/', '_'), ('№', 'N'), (' ', '_'), ('–', '-'), ('á', 'a'), (' ', '_')):
+    for c, r in FILENAME_REPLACED_CHARS:
         filename = filename.replace(c, r)
 
-    return filename + '.' + file_type
+    return filename
+
+
+def make_filename_table() -> typing.Dict[int, str]:
+    # transliterate's "ru" rules only ever look at one character, so translit + cleanup of the whole
+    # filename is the same as doing both for every character on its own
+    chars = {chr(code) for code in range(0x0400, 0x0530)}  # the ranges the "ru" pack works on
+    chars.update(FILENAME_REMOVED_CHARS)
+    chars.update(c for c, _ in FILENAME_REPLACED_CHARS)
+    table = {}
+    for char in chars:
+        converted = clean_filename_chars(transliterate.translit(char, 'ru', reversed=True))
+        if converted != char:
+            table[ord(char)] = converted
+    return table
+
+
+FILENAME_TABLE = make_filename_table()
+FILENAME_CACHE = TTLCache(max_size=10_000, name="filename")
+
+
+async def normalize(book: Book, file_type: str) -> str:
+    key = (book.id, file_type)
+    filename = FILENAME_CACHE.get(key)
+    if filename is None:
+        filename = '_'.join([a.short for a in book.authors]) + '_-_' if book.authors else ''
+        filename += book.title if book.title[-1] != ' ' else book.title[:-1]
+        filename = filename.translate(FILENAME_TABLE) + '.' + file_type
+        FILENAME_CACHE.set(key, filename)
+    return filename
+
+
+def pages_count(count: int) -> int:
+    return count // ELEMENTS_ON_PAGE + (1 if count % ELEMENTS_ON_PAGE != 0 else 0)
+
+
+class SearchCache:
+    TTL = 15 * 60
+
+    SEARCHES = {
+        "b": (Book.search_raw, BookSearchResult),
+        "a": (Author.search_raw, AuthorSearchResult),
+        "s": (Sequence.search_raw, SequenceSearchResult)
+    }
+
+    prefetching: Set[str] = set()
+    prefetch_tasks: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def make_key(search_type: str, query: str, allowed_langs: typing.List[str], limit: int, page: int) -> str:
+        normalized_query = ' '.join(query.lower().split())
+        return f"search:{search_type}:{','.join(sorted(allowed_langs))}:{limit}:{page}:{normalized_query}"
+
+    @classmethod
+    async def search(cls, search_type: str, query: str, allowed_langs: typing.List[str], limit: int, page: int):
+        search_raw, result_class = cls.SEARCHES[search_type]
+        key = cls.make_key(search_type, query, allowed_langs, limit, page)
+
+        cached = await RedisClient.run(lambda redis: redis.get(key))
+        if cached is not None:
+            data = json.loads(cached)
+        else:
+            data = await search_raw(query, allowed_langs, limit, page)
+            if data is None:
+                return None
+            await RedisClient.run(lambda redis: redis.set(key, json.dumps(data), expire=cls.TTL))
+
+        for neighbour_page in (page + 1, page - 1):
+            if 1 <= neighbour_page <= pages_count(data["count"]):
+                cls.prefetch(search_type, query, allowed_langs, limit, neighbour_page)
+
+        return result_class(data)
+
+    @classmethod
+    def prefetch(cls, search_type: str, query: str, allowed_langs: typing.List[str], limit: int, page: int):
+        key = cls.make_key(search_type, query, allowed_langs, limit, page)
+        if key in cls.prefetching:
+            return
+        cls.prefetching.add(key)
+        task = asyncio.create_task(cls._prefetch(key, search_type, query, allowed_langs, limit, page))
+        cls.prefetch_tasks.add(task)  # the loop only keeps weak references to tasks
+        task.add_done_callback(lambda _: cls.prefetching.discard(key))
+        task.add_done_callback(cls.prefetch_tasks.discard)
+
+    @classmethod
+    @ignore(Exception)
+    async def _prefetch(cls, key: str, search_type: str, query: str, allowed_langs: typing.List[str],
+                        limit: int, page: int):
+        redis = await RedisClient.get()
+        if await redis.exists(key):
+            return
+        search_raw, _ = cls.SEARCHES[search_type]
+        data = await search_raw(query, allowed_langs, limit, page)
+        if data is not None:
+            await redis.set(key, json.dumps(data), expire=cls.TTL)
+
+
+class SettingsCache:  # user settings: in-process for a minute, in redis for a day, postgres behind both
+    LOCAL_TTL = 60  # other replicas' changes show up after at most this long
+    REDIS_TTL = 24 * 60 * 60
+
+    local = TTLCache(max_size=50_000, ttl=LOCAL_TTL, name="settings")
+
+    @staticmethod
+    def make_key(user_id: int) -> str:
+        return f"settings:{user_id}"
+
+    @classmethod
+    async def get(cls, user_id: int) -> Settings:
+        flags = cls.local.get(user_id)
+        if flags is None:
+            key = cls.make_key(user_id)
+            cached = await RedisClient.run(lambda redis: redis.get(key))
+            if cached is not None:
+                flags = tuple(json.loads(cached))
+            else:
+                settings = await SettingsDB.get(user_id)
+                flags = (settings.allow_ru, settings.allow_be, settings.allow_uk)
+                await RedisClient.run(lambda redis: redis.set(key, json.dumps(flags), expire=cls.REDIS_TTL))
+            cls.local.set(user_id, flags)
+        return Settings(user_id, *flags)  # a fresh object, callers change it before update()
+
+    @classmethod
+    async def update(cls, settings: Settings):
+        await SettingsDB.update(settings)
+        flags = (settings.allow_ru, settings.allow_be, settings.allow_uk)
+        cls.local.set(settings.user_id, flags)
+        key = cls.make_key(settings.user_id)
+        await RedisClient.run(lambda redis: redis.set(key, json.dumps(flags), expire=cls.REDIS_TTL))
+
+
+class RenderedPageCache:  # message text and keyboard of author and series pages
+    TTLS = {
+        "author": 24 * 60 * 60,  # dropped as soon as the update log has a new book by the author
+        "series": 60 * 60  # the update log doesn't say which series a book is in
+    }
+    WATCH_INTERVAL = 10 * 60
+    WATCH_LANGS = ["ru", "uk", "be"]
+
+    task: Optional[asyncio.Task] = None
+    seen_day: Optional[date] = None
+    seen_book_ids: Set[int] = set()
+
+    @staticmethod
+    def make_key(view: str, entity_id: int, allowed_langs: typing.List[str], page: int) -> str:
+        return f"page:{view}:{entity_id}:{','.join(sorted(allowed_langs))}:{page}"
+
+    @staticmethod
+    def make_index_key(view: str, entity_id: int) -> str:
+        return f"page_keys:{view}:{entity_id}"
+
+    @classmethod
+    async def get(cls, view: str, entity_id: int, allowed_langs: typing.List[str],
+                  page: int) -> Optional[typing.Tuple[str, Optional[InlineKeyboardMarkup]]]:
+        key = cls.make_key(view, entity_id, allowed_langs, page)
+        cached = await RedisClient.run(lambda redis: redis.get(key))
+        if cached is None:
+            return None
+        text, keyboard = json.loads(cached)
+        return text, InlineKeyboardMarkup.to_object(keyboard) if keyboard is not None else None
+
+    @classmethod
+    async def set(cls, view: str, entity_id: int, allowed_langs: typing.List[str], page: int,
+                  text: str, keyboard: Optional[InlineKeyboardMarkup]):
+        key = cls.make_key(view, entity_id, allowed_langs, page)
+        index_key = cls.make_index_key(view, entity_id)
+        value = json.dumps([text, keyboard.to_python() if keyboard is not None else None])
+
+        def store(redis):
+            pipeline = redis.pipeline()
+            pipeline.set(key, value, expire=cls.TTLS[view])
+            pipeline.sadd(index_key, key)
+            pipeline.expire(index_key, cls.TTLS[view])
+            return pipeline.execute()
+
+        await RedisClient.run(store)
+
+    @classmethod
+    async def invalidate(cls, view: str, entity_ids: typing.Iterable[int]):
+        index_keys = [cls.make_index_key(view, entity_id) for entity_id in entity_ids]
+        if not index_keys:
+            return
+        redis = await RedisClient.get()
+        pipeline = redis.pipeline()
+        for index_key in index_keys:
+            pipeline.smembers(index_key)
+        keys = [key for members in await pipeline.execute() for key in members]
+        await redis.delete(*index_keys, *keys)
+
+    @classmethod
+    def start(cls):
+        cls.task = asyncio.create_task(cls._watch_update_log())
+
+    @classmethod
+    async def stop(cls):
+        if cls.task is not None:
+            cls.task.cancel()
+            try:
+                await cls.task
+            except asyncio.CancelledError:
+                pass
+            cls.task = None
+
+    @classmethod
+    async def _watch_update_log(cls):
+        while True:
+            await cls.invalidate_updated_authors()
+            await asyncio.sleep(cls.WATCH_INTERVAL)
+
+    @classmethod
+    @ignore(Exception)
+    async def invalidate_updated_authors(cls):
+        today = date.today()
+        books = await UpdateLog.get_range(today, today, cls.WATCH_LANGS)
+        if books is None:
+            return
+        if cls.seen_day != today:
+            cls.seen_day = today
+            cls.seen_book_ids = set()
+        author_ids = set()
+        for book in books:
+            if book.id not in cls.seen_book_ids:
+                cls.seen_book_ids.add(book.id)
+                author_ids.update(author.id for author in book.authors or [])
+        for author_id in author_ids:
+            Author.invalidate_cache(author_id)
+        await cls.invalidate("author", author_ids)
+
+
+class FileIdCache:  # telegram file_id of uploaded books: in-process LRU -> redis -> postgres
+    MEMORY_TTL = 60  # a file_id removed by another replica stays here at most this long
+    REDIS_TTL = 7 * 24 * 60 * 60
+    TIERS = ("memory", "redis", "postgres")
+
+    memory = TTLCache(max_size=10_000, ttl=MEMORY_TTL, name="file_id")
+
+    lookups: typing.Dict[typing.Tuple[str, str], int] = {(tier, result): 0 for tier in TIERS
+                                                          for result in ("hit", "miss")}
+
+    @staticmethod
+    def make_key(book_id: int, file_type: str) -> str:
+        return f"file_id:{book_id}:{file_type}"
+
+    @classmethod
+    def _record(cls, tier: str, hit: bool):
+        cls.lookups[(tier, "hit" if hit else "miss")] += 1
+
+    @classmethod
+    async def get(cls, book_id: int, file_type: str) -> Optional[str]:
+        file_id, _ = await cls.lookup(book_id, file_type)
+        return file_id
+
+    @classmethod
+    async def lookup(cls, book_id: int, file_type: str,
+                     legacy: bool = False) -> typing.Tuple[Optional[str], Optional[bytes]]:
+        # with legacy=True the books channel message id kept in the old per-book hash comes from the same round trip
+        file_id = cls.memory.get((book_id, file_type))
+        cls._record("memory", file_id is not None)
+        if file_id is not None:
+            return file_id, None
+
+        key = cls.make_key(book_id, file_type)
+
+        def fetch(redis):
+            pipeline = redis.pipeline()
+            pipeline.get(key, encoding="utf-8")
+            if legacy:
+                pipeline.hget(book_id, file_type)
+            return pipeline.execute()
+
+        cached, *legacy_msg_id = await RedisClient.run(fetch, default=[None, None] if legacy else [None])
+        cls._record("redis", cached is not None)
+        if cached is not None:
+            cls.memory.set((book_id, file_type), cached)
+            return cached, None
+
+        pb = await PostedBookDB.get(book_id, file_type)
+        cls._record("postgres", pb is not None)
+        if pb is None:
+            return None, legacy_msg_id[0] if legacy_msg_id else None
+        cls.memory.set((book_id, file_type), pb.file_id)
+        await RedisClient.run(lambda redis: redis.set(key, pb.file_id, expire=cls.REDIS_TTL))
+        return pb.file_id, None
+
+    @classmethod
+    async def get_many(cls, keys: typing.List[typing.Tuple[int, str]]
+                       ) -> typing.Dict[typing.Tuple[int, str], Optional[str]]:  # one MGET for every format
+        result = {}
+        missing = []
+        for key in keys:
+            result[key] = cls.memory.get(key)
+            cls._record("memory", result[key] is not None)
+            if result[key] is None:
+                missing.append(key)
+        if not missing:
+            return result
+
+        cached = await RedisClient.run(lambda redis: redis.mget(*[cls.make_key(*key) for key in missing],
+                                                                 encoding="utf-8"),
+                                       default=[None] * len(missing))
+        not_in_redis = []
+        for key, file_id in zip(missing, cached):
+            cls._record("redis", file_id is not None)
+            if file_id is None:
+                not_in_redis.append(key)
+            else:
+                cls.memory.set(key, file_id)
+                result[key] = file_id
+        if not not_in_redis:
+            return result
+
+        posted = await PostedBookDB.get_many(not_in_redis)
+        found = {}
+        for key in not_in_redis:
+            pb = posted.get(key)
+            cls._record("postgres", pb is not None)
+            if pb is None:
+                continue
+            cls.memory.set(key, pb.file_id)
+            result[key] = found[key] = pb.file_id
+        if not found:
+            return result
+
+        def backfill(redis):
+            pipeline = redis.pipeline()
+            for key, file_id in found.items():
+                pipeline.set(cls.make_key(*key), file_id, expire=cls.REDIS_TTL)
+            return pipeline.execute()
+
+        await RedisClient.run(backfill)
+        return result
+
+    @classmethod
+    async def set(cls, book_id: int, file_type: str, file_id: str):
+        cls.memory.set((book_id, file_type), file_id)
+        await RedisClient.run(lambda redis: redis.set(cls.make_key(book_id, file_type), file_id, expire=cls.REDIS_TTL))
+        await PostedBookDB.create_or_update(book_id, file_type, file_id)
+
+    @classmethod
+    async def delete(cls, book_id: int, file_type: str):
+        cls.memory.invalidate((book_id, file_type))
+        await RedisClient.run(lambda redis: redis.delete(cls.make_key(book_id, file_type)))
+        await PostedBookDB.delete(book_id, file_type)
+
+
+class BookPopularity:  # book requests per day, a sorted set per date
+    KEY_TTL = 3 * 24 * 60 * 60
+
+    record_tasks: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def make_key(day: date) -> str:
+        return f"popular_books:{day.isoformat()}"
+
+    @classmethod
+    @ignore(Exception)
+    async def record(cls, book_id: int):
+        key = cls.make_key(date.today())
+        redis = await RedisClient.get()
+        pipeline = redis.pipeline()
+        pipeline.zincrby(key, 1, book_id)
+        pipeline.expire(key, cls.KEY_TTL)
+        await pipeline.execute()
+
+    @classmethod
+    async def top(cls, count: int) -> typing.List[int]:  # today's and yesterday's most requested books
+        today = date.today()
+
+        def fetch(redis):
+            pipeline = redis.pipeline()
+            for day in (today, today - timedelta(days=1)):
+                pipeline.zrevrange(cls.make_key(day), 0, count - 1)
+            return pipeline.execute()
+
+        result = []
+        for book_ids in await RedisClient.run(fetch, default=[]):
+            for book_id in book_ids:
+                if int(book_id) not in result:
+                    result.append(int(book_id))
+        return result[:count]
 
 
 def need_one_or_more_langs(fn):
@@ -72,28 +470,22 @@ def need_one_or_more_langs(fn):
                 break
         if msg is None:
             raise Exception("Message not found!")
-        allowed_langs = (await SettingsDB.get(msg.chat.id)).get()
+        allowed_langs = (await SettingsCache.get(msg.chat.id)).get()
         if not allowed_langs:
             return await Sender.try_reply_or_send_message(msg.chat.id, "Нужно выбрать хотя бы один язык! /settings",
                                                           reply_to_message_id=msg.message_id)
-        return await fn(*args, **kwargs)
+        return await fn(*args, allowed_langs=allowed_langs, **kwargs)
     return wrapper
 
 
 class Sender:
     bot: Bot
-    redis_connection: aioredis.Redis
+
+    upload_flights = SingleFlight()
 
     @classmethod
     def configure(cls, bot: Bot):
         cls.bot = bot
-        cls.redis_connection = None
-
-    @classmethod
-    async def get_redis_connection(cls):
-        if not cls.redis_connection:
-            cls.redis_connection = await aioredis.create_redis(Config.REDIS_HOST, password=Config.REDIS_PASSWORD)
-        return cls.redis_connection
 
     @classmethod
     async def send_document(cls, chat_id: typing.Union[base.Integer, base.String],
@@ -137,18 +529,29 @@ class Sender:
 
     @staticmethod
     async def remove_cache(type_: str, id_: int):
-        await PostedBookDB.delete(id_, type_)
+        Book.invalidate_cache(id_)
+        await FileIdCache.delete(id_, type_)
 
     @classmethod
     async def send_book(cls, msg: Message, book_id: int, file_type: str):
+        if Book.is_missing(book_id):
+            return await msg.reply("Книга не найдена!")
+        if Book.is_unavailable(book_id, file_type):
+            return await cls.try_reply_or_send_message(msg.chat.id,
+                                                       "Ошибка! Попробуйте позже :(",
+                                                       reply_to_message_id=msg.message_id)
         async with Notifier(cls.bot, msg.chat.id, "upload_document"):
             try:
                 book = await Book.get_by_id(book_id)
             except NoContent:
                 await msg.reply("Книга не найдена!")
                 return
-            redis = await cls.get_redis_connection()
-            msg_id = await redis.hget(book_id, file_type)
+            task = asyncio.ensure_future(BookPopularity.record(book_id))
+            BookPopularity.record_tasks.add(task)  # the loop only keeps weak references to tasks
+            task.add_done_callback(BookPopularity.record_tasks.discard)
+            file_id, msg_id = await FileIdCache.lookup(book_id, file_type, legacy=True)
+            if file_id:
+                return await cls.send_book_by_file_id(msg, book, file_id)
             if msg_id:
                 try:
                     book_msg = await cls.bot.forward_message(chat_id=msg.chat.id,
@@ -157,48 +560,77 @@ class Sender:
                     return await book_msg.reply(book.caption, reply_markup=book.share_markup_without_cache)
                 except exceptions.MessageToForwardNotFound:
                     pass  # ToDO: remove message from redis
-            pb = await PostedBookDB.get(book_id, file_type)
-            if pb:
+            await Book.probe_size(book_id, file_type)
+            if Book.is_too_big(book_id, file_type):
+                return await cls.send_download_link(msg, book, file_type)
+            def transfer():
+                return TransferPool.submit(msg.chat.id, lambda: cls.download_and_upload(msg, book, file_type))
+
+            try:
                 try:
-                    await cls.bot.send_document(msg.chat.id, pb.file_id, reply_to_message_id=msg.message_id,
-                                                 caption=book.caption, reply_markup=book.share_markup)
-                except exceptions.BadRequest:
-                    await cls.bot.send_document(msg.chat.id, pb.file_id,
-                                                 caption=book.caption, reply_markup=book.share_markup)
-            else:
-                book_bytes = await Book.download(book_id, file_type)
-                if not book_bytes:
-                    return await cls.try_reply_or_send_message(msg.chat.id, 
-                                                               "Ошибка! Попробуйте позже :(",
-                                                               reply_to_message_id=msg.message_id)
-                if book_bytes.size > 50_000_000:
-                    return await cls.try_reply_or_send_message(
-                        msg.chat.id, 
-                        book.download_caption(file_type), parse_mode="HTML",
-                        reply_to_message_id=msg.message_id
-                    )
-                book_bytes.name = await normalize(book, file_type)
+                    file_id, shared = await cls.upload_flights.do((book_id, file_type), transfer)
+                except UploadFailed as e:
+                    if e.chat_id == msg.chat.id:
+                        raise
+                    file_id, shared = await transfer(), False  # it failed for the leader's chat only
+            except FileTooBig:
+                return await cls.send_download_link(msg, book, file_type)
+            except UploadFailed:
+                file_id = None
+            if file_id is None:
+                return await cls.try_reply_or_send_message(msg.chat.id, 
+                                                           "Ошибка! Попробуйте позже :(",
+                                                           reply_to_message_id=msg.message_id)
+            if shared:
+                await cls.send_book_by_file_id(msg, book, file_id)
+
+    @classmethod
+    async def send_download_link(cls, msg: Message, book: Book, file_type: str):  # too big for a bot upload
+        return await cls.try_reply_or_send_message(msg.chat.id, book.download_caption(file_type), parse_mode="HTML",
+                                                   reply_to_message_id=msg.message_id)
+
+    @classmethod
+    async def send_book_by_file_id(cls, msg: Message, book: Book, file_id: str):
+        try:
+            await cls.bot.send_document(msg.chat.id, file_id, reply_to_message_id=msg.message_id,
+                                        caption=book.caption, reply_markup=book.share_markup)
+        except exceptions.BadRequest:
+            await cls.bot.send_document(msg.chat.id, file_id,
+                                        caption=book.caption, reply_markup=book.share_markup)
+
+    @classmethod
+    async def download_and_upload(cls, msg: Message, book: Book, file_type: str) -> Optional[str]:
+        book_file = await Book.download(book.id, file_type)
+        if not book_file:
+            return None
+        with book_file:
+            book_file.name = await normalize(book, file_type)
+            kwargs = {"reply_to_message_id": msg.message_id, "caption": book.caption, "reply_markup": book.share_markup}
+            for attempt in range(3):
                 try:
-                    send_response = await cls.bot.send_document(msg.chat.id, book_bytes,
-                                                                reply_to_message_id=msg.message_id,
-                                                                caption=book.caption, reply_markup=book.share_markup)
-                except exceptions.TelegramAPIError:
-                    return await cls.try_reply_or_send_message(msg.chat.id,
-                                                               "Ошибка! Попробуйте позже :(",
-                                                               reply_to_message_id=msg.message_id)
+                    send_response = await cls.bot.send_document(msg.chat.id, book_file.get_input_file(), **kwargs)
+                    break
+                except exceptions.RetryAfter:  # the bot has waited out the flood control, the file has to be sent again
+                    continue
                 except exceptions.BadRequest:
-                    book_bytes = book_bytes.get_copy()
-                    send_response = await cls.bot.send_document(msg.chat.id, book_bytes,
-                                                                caption=book.caption, reply_markup=book.share_markup)
-                await PostedBookDB.create_or_update(book_id, file_type, send_response.document.file_id)
+                    if "reply_to_message_id" not in kwargs:
+                        raise UploadFailed(msg.chat.id)
+                    del kwargs["reply_to_message_id"]  # the message may be gone, send without replying
+                except exceptions.TelegramAPIError:
+                    raise UploadFailed(msg.chat.id)
+            else:
+                raise UploadFailed(msg.chat.id)
+        file_id = send_response.document.file_id
+        await FileIdCache.set(book.id, file_type, file_id)
+        return file_id
 
     @classmethod
     @need_one_or_more_langs
-    async def search_books(cls, msg: Message, page: int):
+    async def search_books(cls, msg: Message, page: int, allowed_langs: typing.List[str]):
         await cls.bot.send_chat_action(msg.chat.id, 'typing')
-        search_result = await Book.search(msg.reply_to_message.text,
-                                          (await SettingsDB.get(msg.chat.id)).get(), 
-                                          ELEMENTS_ON_PAGE, page)
+        search_result = await SearchCache.search("b", msg.reply_to_message.text,
+                                                 allowed_langs,
+                                                 ELEMENTS_ON_PAGE, page)
         if not search_result:
             await cls.bot.edit_message_text('Книги не найдены!', chat_id=msg.chat.id, message_id=msg.message_id)
             return
@@ -210,11 +642,11 @@ class Sender:
 
     @classmethod
     @need_one_or_more_langs
-    async def search_authors(cls, msg: Message, page: int):
+    async def search_authors(cls, msg: Message, page: int, allowed_langs: typing.List[str]):
         await cls.bot.send_chat_action(msg.chat.id, 'typing')
-        search_result = await Author.search(msg.reply_to_message.text, 
-                                            (await SettingsDB.get(msg.chat.id)).get(), 
-                                            ELEMENTS_ON_PAGE, page)
+        search_result = await SearchCache.search("a", msg.reply_to_message.text,
+                                                 allowed_langs,
+                                                 ELEMENTS_ON_PAGE, page)
         if not search_result:
             await cls.bot.edit_message_text('Автор не найден!', chat_id=msg.chat.id, message_id=msg.message_id)
             return
@@ -226,40 +658,46 @@ class Sender:
 
     @classmethod
     @need_one_or_more_langs
-    async def search_books_by_author(cls, msg: Message, author_id: int, page: int):
-        await cls.bot.send_chat_action(msg.chat.id, 'typing')
-        try:
-            author = await Author.by_id(author_id, (await SettingsDB.get(msg.chat.id)).get(), ELEMENTS_ON_PAGE, page)
-        except NoContent:
-            return await msg.reply("Автор не найден!")
-        books = author.books
-        if not books:
-            await msg.reply('Ошибка! Книги не найдены!')
-            return
-        page_max = author.count // ELEMENTS_ON_PAGE + (1 if author.count % ELEMENTS_ON_PAGE != 0 else 0)
-        msg_text = f"<b>{author.normal_name}:</b>"
-        if author.annotation_exists:
-            msg_text += f"\nОб авторе: /a_info_{author.id}\n\n"
+    async def search_books_by_author(cls, msg: Message, author_id: int, page: int, allowed_langs: typing.List[str]):
+        cached = await RenderedPageCache.get("author", author_id, allowed_langs, page)
+        if cached is not None:
+            msg_text, keyboard = cached
         else:
-            msg_text += "\n\n"
-        msg_text += ''.join([book.to_send_book_without_author for book in books]) + \
-            f'<code>Страница {page}/{page_max}</code>'                   
+            await cls.bot.send_chat_action(msg.chat.id, 'typing')
+            try:
+                author = await Author.by_id(author_id, allowed_langs, ELEMENTS_ON_PAGE, page)
+            except NoContent:
+                return await msg.reply("Автор не найден!")
+            books = author.books
+            if not books:
+                await msg.reply('Ошибка! Книги не найдены!')
+                return
+            page_max = pages_count(author.count)
+            msg_text = f"<b>{author.normal_name}:</b>"
+            if author.annotation_exists:
+                msg_text += f"\nОб авторе: /a_info_{author.id}\n\n"
+            else:
+                msg_text += "\n\n"
+            msg_text += ''.join([book.to_send_book_without_author for book in books]) + \
+                f'<code>Страница {page}/{page_max}</code>'
+            keyboard = await get_keyboard(page, page_max, 'ba')
+            await RenderedPageCache.set("author", author_id, allowed_langs, page, msg_text, keyboard)
         if not msg.reply_to_message:
             await cls.try_reply_or_send_message(msg.chat.id, msg_text, parse_mode='HTML', 
-                                                reply_markup=await get_keyboard(1, page_max, 'ba'),
+                                                reply_markup=keyboard,
                                                 reply_to_message_id=msg.message_id
             )
         else:
             await cls.bot.edit_message_text(msg_text, msg.chat.id, msg.message_id, parse_mode='HTML',
-                                             reply_markup=await get_keyboard(page, page_max, 'ba'))
+                                             reply_markup=keyboard)
 
     @classmethod
     @need_one_or_more_langs
-    async def search_series(cls, msg: Message, page: int):
+    async def search_series(cls, msg: Message, page: int, allowed_langs: typing.List[str]):
         await cls.bot.send_chat_action(msg.chat.id, 'typing')
-        sequences_result = await Sequence.search(msg.reply_to_message.text, 
-                                                 (await SettingsDB.get(msg.chat.id)).get(), 
-                                                 ELEMENTS_ON_PAGE, page)
+        sequences_result = await SearchCache.search("s", msg.reply_to_message.text,
+                                                    allowed_langs,
+                                                    ELEMENTS_ON_PAGE, page)
         if not sequences_result:
             return await cls.try_reply_or_send_message(msg.chat.id, 'Ошибка! Серии не найдены!',
                                                        reply_to_message_id=msg.message_id)
@@ -272,31 +710,37 @@ class Sender:
 
     @classmethod
     @need_one_or_more_langs
-    async def search_books_by_series(cls, msg: Message, series_id: int, page: int):
-        await cls.bot.send_chat_action(msg.chat.id, 'typing')
-        search_result = await Sequence.get_by_id(series_id, (await SettingsDB.get(msg.chat.id)).get(), ELEMENTS_ON_PAGE, page)
-        books = search_result.books
-        if not books:
-            return await cls.try_reply_or_send_message(msg.chat.id, 'Ошибка! Книги в серии не найдены!',
-                                                       reply_to_message_id=msg.message_id)
-        page_max = search_result.count // ELEMENTS_ON_PAGE + (1 if search_result.count % ELEMENTS_ON_PAGE != 0 else 0)
-        msg_text = f"<b>{search_result.name}:</b>\n\n" + \
-                   ''.join([book.to_send_book for book in books]
-                           ) + f'<code>Страница {page}/{page_max}</code>'
+    async def search_books_by_series(cls, msg: Message, series_id: int, page: int, allowed_langs: typing.List[str]):
+        cached = await RenderedPageCache.get("series", series_id, allowed_langs, page)
+        if cached is not None:
+            msg_text, keyboard = cached
+        else:
+            await cls.bot.send_chat_action(msg.chat.id, 'typing')
+            search_result = await Sequence.get_by_id(series_id, allowed_langs, ELEMENTS_ON_PAGE, page)
+            books = search_result.books
+            if not books:
+                return await cls.try_reply_or_send_message(msg.chat.id, 'Ошибка! Книги в серии не найдены!',
+                                                           reply_to_message_id=msg.message_id)
+            page_max = pages_count(search_result.count)
+            msg_text = f"<b>{search_result.name}:</b>\n\n" + \
+                       ''.join([book.to_send_book for book in books]
+                               ) + f'<code>Страница {page}/{page_max}</code>'
+            keyboard = await get_keyboard(page, page_max, 'bs')
+            await RenderedPageCache.set("series", series_id, allowed_langs, page, msg_text, keyboard)
         if not msg.reply_to_message:
             await cls.try_reply_or_send_message(msg.chat.id, msg_text, parse_mode='HTML', 
-                                                reply_markup=await get_keyboard(1, page_max, 'bs'),
+                                                reply_markup=keyboard,
                                                 reply_to_message_id=msg.message_id)
         else:
             await cls.bot.edit_message_text(msg_text, msg.chat.id, msg.message_id, parse_mode='HTML',
-                                             reply_markup=await get_keyboard(page, page_max, 'bs'))
+                                             reply_markup=keyboard)
 
     @classmethod
     @need_one_or_more_langs
-    async def get_random_book(cls, msg: Message):
+    async def get_random_book(cls, msg: Message, allowed_langs: typing.List[str]):
         await cls.bot.send_chat_action(msg.chat.id, 'typing')
         try:
-            book = await Book.get_random((await SettingsDB.get(msg.chat.id)).get())
+            book = await RandomPool.get("book", allowed_langs)
             await cls.try_reply_or_send_message(msg.chat.id, book.to_send_book, parse_mode='HTML',
                                                 reply_to_message_id=msg.message_id)
         except NoContent:
@@ -304,10 +748,10 @@ class Sender:
 
     @classmethod
     @need_one_or_more_langs
-    async def get_random_author(cls, msg: Message):
+    async def get_random_author(cls, msg: Message, allowed_langs: typing.List[str]):
         await cls.bot.send_chat_action(msg.chat.id, 'typing')
         try:
-            author = await Author.get_random((await SettingsDB.get(msg.chat.id)).get())
+            author = await RandomPool.get("author", allowed_langs)
             await cls.try_reply_or_send_message(msg.chat.id, author.to_send, parse_mode='HTML',
                                                 reply_to_message_id=msg.message_id)
         except NoContent:
@@ -315,10 +759,10 @@ class Sender:
 
     @classmethod
     @need_one_or_more_langs
-    async def get_random_sequence(cls, msg: Message):
+    async def get_random_sequence(cls, msg: Message, allowed_langs: typing.List[str]):
         await cls.bot.send_chat_action(msg.chat.id, 'typing')
         try:
-            sequence = await Sequence.get_random((await SettingsDB.get(msg.chat.id)).get())
+            sequence = await RandomPool.get("sequence", allowed_langs)
             await cls.try_reply_or_send_message(msg.chat.id, sequence.to_send, parse_mode="HTML",
                                                 reply_to_message_id=msg.message_id)
         except NoContent:
@@ -326,29 +770,22 @@ class Sender:
 
     @classmethod
     @need_one_or_more_langs
-    async def send_book_annotation(cls, msg: Message, book_id: int):
+    async def send_book_annotation(cls, msg: Message, book_id: int, allowed_langs: typing.List[str]):
         try:
             await cls.bot.send_chat_action(msg.chat.id, 'typing')
             annotation = await BookAnnotation.get_by_book_id(book_id)
             if annotation.photo_link:
+                first_chunk, *chunks = annotation.get_chunks(CAPTION_LENGTH_LIMIT)
                 msg = await cls.bot.send_photo(msg.chat.id, annotation.photo_link,
-                                               caption=annotation.to_send[:1024], parse_mode="HTML",
+                                               caption=first_chunk, parse_mode="HTML",
                                                reply_to_message_id=msg.message_id)
-                if len(annotation.to_send) > 1024:
-                    i = 1024
-                    while annotation.to_send[i:i + 4096]:
-                        msg = await cls.try_reply_or_send_message(msg.chat.id, annotation.to_send[i:i+4096], parse_mode="HTML",
-                                                                  reply_to_message_id=msg.message_id)
-                        i += len(msg.text)
             else:
-                msg = await cls.try_reply_or_send_message(msg.chat.id, annotation.to_send[:4096], parse_mode="HTML",
+                first_chunk, *chunks = annotation.get_chunks(MESSAGE_LENGTH_LIMIT)
+                msg = await cls.try_reply_or_send_message(msg.chat.id, first_chunk, parse_mode="HTML",
+                                                          reply_to_message_id=msg.message_id)
+            for chunk in chunks:
+                msg = await cls.try_reply_or_send_message(msg.chat.id, chunk, parse_mode="HTML",
                                                           reply_to_message_id=msg.message_id)
-                if len(annotation.to_send) > 4096:
-                    i = 4096
-                    while annotation.to_send[i:i + 4096]:
-                        msg = await cls.try_reply_or_send_message(msg.chat.id, annotation.to_send[i:i+4096], parse_mode="HTML",
-                                                                  reply_to_message_id=msg.message_id)
-                        i += len(msg.text)
         except NoContent:
             await cls.try_reply_or_send_message(msg.chat.id, "Нет аннотации для этой книги!",
                                                 reply_to_message_id=msg.message_id)
@@ -356,29 +793,22 @@ class Sender:
 
     @classmethod
     @need_one_or_more_langs
-    async def send_author_annotation(cls, msg: Message, author_id: int):
+    async def send_author_annotation(cls, msg: Message, author_id: int, allowed_langs: typing.List[str]):
         try:
             await cls.bot.send_chat_action(msg.chat.id, 'typing')
             annotation = await AuthorAnnotation.get_by_author_id(author_id)
             if annotation.photo_link:
+                first_chunk, *chunks = annotation.get_chunks(CAPTION_LENGTH_LIMIT)
                 await cls.try_reply_or_send_photo(msg.chat.id, annotation.photo_link,
-                                                  caption=annotation.to_send[:1024], parse_mode="HTML",
+                                                  caption=first_chunk, parse_mode="HTML",
                                                   reply_to_message_id=msg.message_id)
-                if len(annotation.to_send) > 1024:
-                    i = 1024
-                    while annotation.to_send[i:i + 4096]:
-                        msg = await cls.try_reply_or_send_message(msg.chat.id, annotation.to_send[i:i+4096], parse_mode="HTML",
-                                                                  reply_to_message_id=msg.message_id)
-                        i += len(msg.text)
             else:
-                await cls.try_reply_or_send_message(msg.chat.id, annotation.to_send[:4096], parse_mode="HTML",
+                first_chunk, *chunks = annotation.get_chunks(MESSAGE_LENGTH_LIMIT)
+                await cls.try_reply_or_send_message(msg.chat.id, first_chunk, parse_mode="HTML",
                                                     reply_to_message_id=msg.message_id)
-                if len(annotation.to_send) > 4096:
-                    i = 4096
-                    while annotation.to_send[i:i + 4096]:
-                        msg = await cls.try_reply_or_send_message(msg.chat.id, annotation.to_send[i:i+4096], parse_mode="HTML",
-                                                                  reply_to_message_id=msg.message_id)
-                        i += len(msg.text)
+            for chunk in chunks:
+                msg = await cls.try_reply_or_send_message(msg.chat.id, chunk, parse_mode="HTML",
+                                                          reply_to_message_id=msg.message_id)
         except NoContent:
             await cls.try_reply_or_send_message(msg.chat.id, "Нет информации для этого автора!",
                                                 reply_to_message_id=msg.message_id)
@@ -386,8 +816,9 @@ class Sender:
 
     @classmethod
     @need_one_or_more_langs
-    async def send_day_update_log(cls, msg: types.Message, start_date: date, end_date: date, page: int, type_: str):
-        update_log = await UpdateLog.get_by_day(start_date, end_date, (await SettingsDB.get(msg.chat.id)).get(), 7, page)
+    async def send_day_update_log(cls, msg: types.Message, start_date: date, end_date: date, page: int, type_: str,
+                                  allowed_langs: typing.List[str]):
+        update_log = await UpdateLog.get_by_day(start_date, end_date, allowed_langs, 7, page)
         if not update_log:
             await cls.bot.edit_message_text('Обновления не найдены!', chat_id=msg.chat.id, message_id=msg.message_id)
             return
@@ -401,3 +832,9 @@ class Sender:
         await cls.bot.edit_message_text(msg_text, chat_id=msg.chat.id, message_id=msg.message_id, parse_mode='HTML',
                                         reply_markup=await get_keyboard(page, page_count, 
                                         f'ul_{type_}_{start_date.isoformat()}_{end_date.isoformat()}'))
+
+
+metrics.counter("book_upload_coalesced_total", "Book requests that reused an in-flight download and upload",
+                callback=lambda: {(): Sender.upload_flights.coalesced})
+metrics.counter("file_id_cache_lookups_total", "Book file_id lookups by cache tier and result", ["tier", "result"],
+                callback=lambda: dict(FileIdCache.lookups))
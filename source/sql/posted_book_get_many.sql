@@ -0,0 +1 @@
+SELECT * FROM posted_book WHERE (book_id, file_type) IN (SELECT * FROM unnest($1::INTEGER[], $2::VARCHAR[]));
\ No newline at end of file
@@ -41,3 +41,6 @@ cache_removed = (
     "Файл обновлен!"
 )
 share = "Поделиться"
+service_unavailable = (
+    "Сервер с книгами сейчас недоступен :( Попробуйте через пару минут."
+)
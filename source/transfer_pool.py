@@ -0,0 +1,123 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+import metrics
+from config import Config
+
+
+WAIT_TIME = metrics.histogram("transfer_queue_wait_seconds", "Time book transfers wait for a worker", ["priority"],
+                              buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+
+
+class Job(NamedTuple):
+    fn: Callable[[], Awaitable[Any]]
+    future: asyncio.Future
+    enqueued_at: float
+
+
+class TransferPool:  # book downloads and uploads, a fixed number of workers taking chats in turn
+    USER = 0
+    WARMUP = 1
+    PRIORITY_NAMES = {USER: "user", WARMUP: "warmup"}
+
+    queues: Dict[int, "OrderedDict[Hashable, Deque[Job]]"] = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+    active: Dict[Hashable, int] = {}
+    running: int = 0
+
+    workers: List[asyncio.Task] = []
+    condition: Optional[asyncio.Condition] = None
+    stopping: bool = False
+
+    @classmethod
+    def start(cls):
+        cls.condition = asyncio.Condition()
+        cls.stopping = False
+        cls.workers = [asyncio.create_task(cls._worker()) for _ in range(Config.TRANSFER_WORKERS)]
+
+    @classmethod
+    async def stop(cls):
+        cls.stopping = True
+        for worker in cls.workers:
+            worker.cancel()
+        await asyncio.gather(*cls.workers, return_exceptions=True)
+        cls.workers = []
+        for chats in cls.queues.values():  # nobody will run them any more
+            for jobs in chats.values():
+                for job in jobs:
+                    job.future.cancel()
+            chats.clear()
+
+    @classmethod
+    async def submit(cls, chat_id: Hashable, fn: Callable[[], Awaitable[Any]], priority: int = USER) -> Any:
+        if cls.condition is None:
+            return await fn()
+        future = asyncio.get_event_loop().create_future()
+        cls.queues[priority].setdefault(chat_id, deque()).append(Job(fn, future, time.monotonic()))
+        async with cls.condition:
+            cls.condition.notify()
+        return await future
+
+    @classmethod
+    def depth(cls, priority: int) -> int:
+        return sum(len(jobs) for jobs in cls.queues[priority].values())
+
+    @classmethod
+    def _pick(cls) -> Optional[Tuple[Hashable, int, Job]]:
+        for priority, chats in cls.queues.items():
+            for chat_id in list(chats):
+                if cls.active.get(chat_id, 0) >= Config.TRANSFER_PER_CHAT_LIMIT:
+                    continue
+                jobs = chats.pop(chat_id)
+                job = jobs.popleft()
+                if jobs:
+                    chats[chat_id] = jobs  # back of the line, other chats go first
+                return chat_id, priority, job
+        return None
+
+    @classmethod
+    async def _worker(cls):
+        while True:
+            async with cls.condition:
+                picked = cls._pick()
+                while picked is None:
+                    await cls.condition.wait()
+                    picked = cls._pick()
+            chat_id, priority, job = picked
+            if job.future.done():  # the handler has gone away
+                continue
+            WAIT_TIME.observe(time.monotonic() - job.enqueued_at, priority=cls.PRIORITY_NAMES[priority])
+
+            cls.active[chat_id] = cls.active.get(chat_id, 0) + 1
+            cls.running += 1
+            try:
+                result = await job.fn()
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                if cls.stopping:
+                    raise
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            except BaseException:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                cls.running -= 1
+                cls.active[chat_id] -= 1
+                if not cls.active[chat_id]:
+                    del cls.active[chat_id]
+                async with cls.condition:
+                    cls.condition.notify()
+
+
+metrics.gauge("transfer_queue_depth", "Book transfers waiting for a worker", ["priority"],
+              callback=lambda: {(name, ): TransferPool.depth(priority)
+                                for priority, name in TransferPool.PRIORITY_NAMES.items()})
+metrics.gauge("transfer_running", "Book transfers in progress", callback=lambda: {(): TransferPool.running})
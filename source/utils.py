@@ -1,6 +1,8 @@
-from db import SettingsDB
+from db import SettingsDB, Settings
 
 import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
 from aiogram import types
 
 from functools import wraps
@@ -26,8 +28,38 @@ def ignore(exception):
     return ignore
 
 
-async def make_settings_keyboard(user_id: int) -> types.InlineKeyboardMarkup:
-    settings = await SettingsDB.get(user_id)
+class SingleFlight:
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        future = self.calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_event_loop().create_future()
+        self.calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark as retrieved when nobody is waiting
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self.calls[key]
+        return result, False
+
+
+async def make_settings_keyboard(user_id: int, settings: Optional[Settings] = None) -> types.InlineKeyboardMarkup:
+    if settings is None:
+        settings = await SettingsDB.get(user_id)
     keyboard = types.InlineKeyboardMarkup()
     if not settings.allow_ru:
         keyboard.row(types.InlineKeyboardButton("Русский: 🅾 выключен!", callback_data="ru_on"))